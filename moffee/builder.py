@@ -1,10 +1,87 @@
-from typing import List
+from concurrent.futures import Executor
+from dataclasses import dataclass, replace
+from functools import lru_cache
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
+import io
 import os
-from jinja2 import Environment, FileSystemLoader
-from moffee.compositor import Page, PageOption, composite, parse_frontmatter
-from moffee.markdown import md
-from moffee.utils.md_helper import extract_title
-from moffee.utils.file_helper import redirect_paths, copy_assets, merge_directories
+import pickle
+import warnings
+from threading import Event
+from urllib.parse import quote, unquote
+from jinja2 import (
+    BaseLoader,
+    BytecodeCache,
+    ChoiceLoader,
+    Environment,
+    FileSystemBytecodeCache,
+    FileSystemLoader,
+    pass_context,
+)
+from markupsafe import Markup
+from moffee.compositor import (
+    Chunk,
+    Page,
+    PageOption,
+    Type,
+    diff_lines,
+    paginate,
+    parse_frontmatter,
+    repaginate,
+)
+from moffee.markdown import md, render_many
+from moffee.utils.cache import DiskCache, content_key
+from moffee.utils.md_helper import rm_comments
+from moffee.utils.file_helper import (
+    AssetStore,
+    asset_name,
+    asset_source,
+    merge_directories,
+    path_index,
+    resolve_base_paths,
+    rewrite_url_stream,
+)
+
+
+# Characters read at a time when streaming html back from disk
+STREAM_BLOCK_SIZE = 64 * 1024
+
+# Entries of a template directory that are jinja2 templates, everything else is static
+TEMPLATE_ENTRIES = ["index.html", "layouts"]
+
+# Environments kept alive at once, one per template and theme directory pair
+MAX_ENVIRONMENTS = 16
+
+
+# Classes a cached document is made of, nothing else is unpickled from the disk cache.
+# Front matter may hold YAML timestamps, which load as dates and datetimes
+CACHED_CLASSES = {
+    ("moffee.builder", "Document"),
+    ("moffee.compositor", "Page"),
+    ("moffee.compositor", "PageOption"),
+    ("moffee.compositor", "Chunk"),
+    ("datetime", "date"),
+    ("datetime", "datetime"),
+    ("datetime", "timedelta"),
+    ("datetime", "timezone"),
+}
+
+
+class CachedDocumentUnpickler(pickle.Unpickler):
+    """Unpickler refusing anything but the classes of a cached document"""
+
+    def find_class(self, module, name):
+        if (module, name) not in CACHED_CLASSES:
+            raise pickle.UnpicklingError(f"{module}.{name} is not a document class")
+        return super().find_class(module, name)
+
+
+class BuildCancelled(Exception):
+    """Raised by build when its cancel event is set"""
+
+
+def check_cancelled(cancel: Optional[Event]):
+    if cancel is not None and cancel.is_set():
+        raise BuildCancelled()
 
 
 def read_options(document_path) -> PageOption:
@@ -55,59 +132,400 @@ def retrieve_structure(pages: List[Page]) -> dict:
     return {"page_meta": page_meta, "headings": headings}
 
 
-def render_jinja2(document: str, template_dir) -> str:
-    """Run jinja2 templating to create html"""
-    # Setup Jinja 2
-    env = Environment(loader=FileSystemLoader(template_dir))
+@dataclass
+class Document:
+    """
+    A markdown document parsed once into everything the build needs.
+
+    :ivar source: Raw text of the document
+    :ivar path: Path the document was read from, if any
+    :ivar content: Markdown with comments and front matter removed
+    :ivar options: Document-wide options from the front matter
+    :ivar title: First level 1 or 2 heading, or "Untitled"
+    :ivar pages: Paginated slides
+    :ivar structure: Heading structure, see retrieve_structure
+    """
+
+    source: str
+    path: Optional[str]
+    content: str
+    options: PageOption
+    title: str
+    pages: List[Page]
+    structure: dict
+
+    @classmethod
+    def parse(
+        cls,
+        source: str,
+        path: Optional[str] = None,
+        disk_cache: Optional[DiskCache] = None,
+    ) -> "Document":
+        """
+        Parse document text, reusing the result for an identical text from disk_cache.
+        Cached documents are pickled, see DiskCache about trusting its directory.
+        """
+        data = disk_cache.get("pages", source) if disk_cache else None
+        if data is not None:
+            try:
+                cached = CachedDocumentUnpickler(io.BytesIO(data)).load()
+                return replace(cached, source=source, path=path)
+            except Exception:
+                pass
+
+        content, options = parse_frontmatter(rm_comments(source))
+        document = cls._from_pages(
+            source, path, content, options, paginate(content, options)
+        )
+        # An entry that failed to load would fail again once written back
+        if disk_cache and data is None:
+            cached = replace(document, source="", path=None)
+            disk_cache.put("pages", source, pickle.dumps(cached))
+        return document
+
+    @classmethod
+    def _from_pages(
+        cls,
+        source: str,
+        path: Optional[str],
+        content: str,
+        options: PageOption,
+        pages: List[Page],
+    ) -> "Document":
+        title = next((page.h1 or page.h2 for page in pages if page.h1 or page.h2), None)
+        return cls(
+            source=source,
+            path=path,
+            content=content,
+            options=options,
+            title=title or "Untitled",
+            pages=pages,
+            structure=retrieve_structure(pages),
+        )
+
+    def update(self, source: str) -> "Document":
+        """
+        Parse a new version of this document.
+        Only pages around the changed lines are paginated again, unless the front matter changed.
+        """
+        content, options = parse_frontmatter(rm_comments(source))
+        if options != self.options:
+            return Document.parse(source, path=self.path)
+
+        edit = diff_lines(self.content.split("\n"), content.split("\n"))
+        pages = repaginate(self.pages, content, options, edit)
+        return Document._from_pages(source, self.path, content, options, pages)
+
+    @classmethod
+    def load(cls, path: str, disk_cache: Optional[DiskCache] = None) -> "Document":
+        """Read and parse the document at path"""
+        with open(path, encoding="utf8") as f:
+            source = f.read()
+        return cls.parse(source, path=path, disk_cache=disk_cache)
+
+
+def iter_paragraphs(chunk: Chunk) -> Iterator[str]:
+    """Yield the markdown of every paragraph in a chunk tree, in document order"""
+    if chunk.type == Type.PARAGRAPH:
+        yield chunk.paragraph
+    for child in chunk.children:
+        yield from iter_paragraphs(child)
+
+
+def slide_id(number: int, page: Page) -> str:
+    """Identify a slide by everything it is rendered from, so it keeps its id while unchanged"""
+    key = repr((number, page.raw_md, page.h1, page.h2, page.h3, page.option))
+    return content_key(key)[:16]
+
+
+def template_loader(template_dir: str, theme_dir: Optional[str] = None) -> BaseLoader:
+    """
+    Loader of the templates of a theme, falling back to template_dir for those the theme does not override.
+    Templates are read from where they are, nothing is copied.
+    """
+    loaders = [FileSystemLoader(template_dir)]
+    if theme_dir:
+        loaders.insert(0, FileSystemLoader(theme_dir))
+    return ChoiceLoader(loaders)
+
 
-    env.filters["markdown"] = md
+def template_bytecode_cache(cache_dir: Optional[str]) -> Optional[BytecodeCache]:
+    """
+    On-disk cache of compiled templates under cache_dir/templates.
+    Entries carry a checksum of the template source, so edited templates are compiled again.
+    """
+    if not cache_dir:
+        return None
+    directory = os.path.join(os.path.abspath(cache_dir), "templates")
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError:
+        return None
+    return FileSystemBytecodeCache(directory)
 
+
+@pass_context
+def markdown_filter(context, text):
+    """Convert markdown with the converter of the render in progress, if any"""
+    convert = context.get("_markdown")
+    if convert is None:
+        return md(text)
+    return convert(text)
+
+
+@lru_cache(maxsize=MAX_ENVIRONMENTS)
+def template_environment(
+    template_dir: str,
+    theme_dir: Optional[str] = None,
+    cache_dir: Optional[str] = None,
+) -> Environment:
+    """
+    Jinja2 environment of a template and theme directory pair, shared by every render of the process.
+    Compiled templates are kept in memory and, if cache_dir is given, on disk across runs.
+    Templates changed on disk are reloaded.
+    """
+    env = Environment(
+        loader=template_loader(template_dir, theme_dir),
+        bytecode_cache=template_bytecode_cache(cache_dir),
+        auto_reload=True,
+    )
+    env.filters["markdown"] = markdown_filter
+    return env
+
+
+def render_jinja2(
+    document: Union[str, Document],
+    template_dir,
+    disk_cache: Optional[DiskCache] = None,
+    jobs: int = 1,
+    theme_dir: Optional[str] = None,
+    live: bool = False,
+) -> str:
+    """
+    Run jinja2 templating to create html.
+    All paragraphs are converted up front, over `jobs` worker processes,
+    so the markdown filter only looks up the results while templating.
+    Templates in theme_dir, if given, take precedence over those in template_dir.
+    With live set, the page includes the script patching slides pushed by live mode.
+    """
+    html = generate_jinja2(
+        document, template_dir, disk_cache, jobs=jobs, theme_dir=theme_dir, live=live
+    )
+    return "".join(html)
+
+
+def generate_jinja2(
+    document: Union[str, Document],
+    template_dir,
+    disk_cache: Optional[DiskCache] = None,
+    jobs: int = 1,
+    theme_dir: Optional[str] = None,
+    live: bool = False,
+    executor: Optional[Executor] = None,
+) -> Iterator[str]:
+    """
+    Streaming version of render_jinja2, returns an iterator of html pieces
+    produced as the template is filled. The template is loaded right away.
+    Every paragraph is converted before the first piece, and its html kept
+    until the template is filled, so only the templating output is streamed.
+    Paragraphs are converted over executor instead of new workers if it is given.
+    """
+    if isinstance(document, str):
+        document = Document.parse(document, disk_cache=disk_cache)
+    pages = document.pages
+    chunks = [page.chunk for page in pages]
+    # Converted without the document location so the cached html is shared between
+    # copies of a document, relative URLs are resolved once the page is rendered
+    rendered = render_many(
+        [text for chunk in chunks for text in iter_paragraphs(chunk)],
+        jobs=jobs,
+        disk_cache=disk_cache,
+        executor=executor,
+    )
+
+    def convert(text):
+        if text in rendered:
+            return Markup(rendered[text])
+        return md(text, disk_cache=disk_cache)
+
+    env = template_environment(
+        os.path.abspath(template_dir),
+        os.path.abspath(theme_dir) if theme_dir else None,
+        disk_cache.root if disk_cache else None,
+    )
     template = env.get_template("index.html")
 
     # Fill template
-    pages = composite(document)
-    title = extract_title(document) or "Untitled"
-    slide_struct = retrieve_structure(pages)
-    _, options = parse_frontmatter(document)
-    width, height = options.computed_slide_size
+    width, height = document.options.computed_slide_size
 
     data = {
-        "title": title,
-        "struct": slide_struct,
+        "_markdown": convert,
+        "title": document.title,
+        "struct": document.structure,
         "slide_width": width,
         "slide_height": height,
+        "live": live,
         "slides": [
             {
+                "id": slide_id(number, page),
                 "h1": page.h1,
                 "h2": page.h2,
                 "h3": page.h3,
-                "chunk": page.chunk,
+                "chunk": chunk,
                 "layout": page.option.layout,
                 "styles": page.option.styles,
             }
-            for page in pages
+            for number, (page, chunk) in enumerate(zip(pages, chunks), 1)
         ],
     }
 
-    return template.render(data)
+    return template.generate(data)
+
+
+def render_in_memory(
+    document: Document,
+    template_dir: str,
+    theme_dir: Optional[str] = None,
+    disk_cache: Optional[DiskCache] = None,
+    jobs: int = 1,
+    live: bool = False,
+    cancel: Optional[Event] = None,
+    executor: Optional[Executor] = None,
+) -> Tuple[str, Dict[str, str]]:
+    """
+    Render a loaded document like build does, without writing anything.
+    Asset URLs point into assets/ under the same names build gives them.
+    live and executor are passed on to generate_jinja2.
+
+    :return: The html, and the path in the output of every asset file it refers to
+    """
+    # Documents parsed from text are resolved against the working directory
+    base_paths = resolve_base_paths(
+        document.path or os.getcwd() + os.sep, document.options.resource_dir
+    )
+    path_index.refresh()
+    assets = {}
+    # Each url is resolved once per render, however often it is referred to
+    rewritten = {}
+
+    def rewrite(url):
+        new_url = rewritten.get(url)
+        if new_url is None:
+            new_url = rewritten[url] = resolve(url)
+        return new_url
+
+    def resolve(url):
+        if not os.path.isabs(url):
+            url = path_index.resolve(unquote(url), base_paths)
+        source = asset_source(url)
+        if source is None:
+            return url
+        name = f"assets/{asset_name(source)}"
+        assets[source] = name
+        return quote(name)
+
+    output_html = generate_jinja2(
+        document,
+        template_dir,
+        disk_cache,
+        jobs=jobs,
+        theme_dir=theme_dir,
+        live=live,
+        executor=executor,
+    )
+    pieces = []
+    for piece in rewrite_url_stream(output_html, rewrite):
+        check_cancelled(cancel)
+        pieces.append(piece)
+    return "".join(pieces), assets
 
 
 def build(
-    document_path: str, output_dir: str, template_dir: str, theme_dir: str = None
+    document_path: str,
+    output_dir: str,
+    template_dir: str,
+    theme_dir: str = None,
+    cache_dir: Optional[str] = None,
+    jobs: int = 1,
+    document: Optional[Document] = None,
+    asset_mode: str = "copy",
+    progress: Optional[Callable[[int, int], None]] = None,
+    live: bool = False,
+    cancel: Optional[Event] = None,
 ):
-    """Render document, create output directories and write result html."""
-    with open(document_path, encoding="utf8") as f:
-        document = f.read()
+    """
+    Render document, create output directories and write result html.
+    The html is written to a temporary file as the template is filled, collecting assets
+    on the way. Assets are then copied concurrently and their URLs rewritten into a second
+    file that replaces index.html. The page itself is held one buffer at a time, but the
+    parsed pages and the html of every paragraph are, see generate_jinja2, so memory
+    still grows with the size of the deck.
+    If cache_dir is given, rendered chunks and pages are cached there across builds.
+    Markdown is converted over `jobs` worker processes.
+    An already parsed document may be passed to skip reading document_path again.
+    asset_mode selects how assets are put into the output, see file_helper.materialize,
+    and progress is called with the number of assets copied and the total.
+    live is passed on to render_jinja2.
+    Once cancel is set, the build stops with BuildCancelled. index.html is replaced
+    only when a build completes, so the last complete output is served meanwhile.
+    """
     asset_dir = os.path.join(output_dir, "assets")
+    disk_cache = DiskCache(cache_dir) if cache_dir else None
+    if document is None:
+        document = Document.load(document_path, disk_cache=disk_cache)
+    check_cancelled(cancel)
 
-    merge_directories(template_dir, output_dir, theme_dir)
-    options = read_options(document_path)
-    output_html = render_jinja2(document, output_dir)
-    output_html = redirect_paths(
-        output_html, document_path=document_path, resource_dir=options.resource_dir
+    # Only static files are copied, templates are rendered from where they are.
+    # Assets of the last build are kept, unchanged ones are not copied again
+    merge_directories(
+        template_dir,
+        output_dir,
+        theme_dir,
+        keep=["assets", "index.html"],
+        exclude=TEMPLATE_ENTRIES,
     )
-    output_html = copy_assets(output_html, asset_dir).replace(asset_dir, "assets")
+    os.makedirs(asset_dir, exist_ok=True)
+    # Only rescan directories changed since the last build
+    path_index.refresh()
+    base_paths = resolve_base_paths(document_path, document.options.resource_dir)
+    store = AssetStore(asset_dir, asset_mode)
+
+    def collect(url):
+        if not os.path.isabs(url):
+            url = path_index.resolve(unquote(url), base_paths)
+        store.add(url)
+        return url
+
+    def rewrite(url):
+        new_path = store.new_path(url)
+        if new_path is None:
+            return url
+        return quote(f"assets/{os.path.basename(new_path)}")
 
+    # Write the html with redirected urls while collecting assets, copy the assets
+    # all at once, then rewrite their urls into the final html
+    output_html = generate_jinja2(
+        document, template_dir, disk_cache, jobs=jobs, theme_dir=theme_dir, live=live
+    )
     output_file = os.path.join(output_dir, f"index.html")
-    with open(output_file, "w", encoding="utf-8") as f:
-        f.write(output_html)
+    collected_file = os.path.join(output_dir, ".index.html.tmp")
+    rewritten_file = os.path.join(output_dir, ".index.html.new")
+    with open(collected_file, "w", encoding="utf-8") as f:
+        for piece in rewrite_url_stream(output_html, collect):
+            check_cancelled(cancel)
+            f.write(piece)
+
+    check_cancelled(cancel)
+    store.copy_all(progress)
+    store.prune()
+    for source, error in store.failed.items():
+        warnings.warn(f"Could not copy asset {source}: {error}", stacklevel=2)
+
+    with (
+        open(collected_file, encoding="utf-8") as src,
+        open(rewritten_file, "w", encoding="utf-8") as f,
+    ):
+        pieces = iter(lambda: src.read(STREAM_BLOCK_SIZE), "")
+        f.writelines(rewrite_url_stream(pieces, rewrite))
+    os.remove(collected_file)
+    os.replace(rewritten_file, output_file)
@@ -1,46 +1,244 @@
 from moffee import __version__
 import click
+import glob
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor
 from functools import partial
-from moffee.builder import build, read_options
-from livereload import Server
+from itertools import repeat
+from moffee.builder import Document, build, render_in_memory
+from moffee.live import LiveServer, OutputTree, Rebuilder, SlidePatcher, push_patch
+from moffee.utils.cache import DiskCache, default_cache_dir
+from moffee.utils.file_helper import ASSET_MODES
 import tempfile
 
 
-def run(md, output=None, live=False):
+def run(md, output=None, live=False, cache_dir=None, jobs=1, asset_mode=None):
     """Process the markdown file to render slides."""
+    if live:
+        disk_cache = DiskCache(cache_dir) if cache_dir else None
+        document, base_template_dir, theme_template_dir = load_deck(md, disk_cache)
+        serve(md, document, base_template_dir, theme_template_dir, disk_cache, jobs)
+        return
+
+    output_file = make_deck(md, output, cache_dir, jobs, asset_mode, echo_progress)
+    print(f"Generated html written to {output_file}")
+
+
+def load_deck(md, disk_cache=None):
+    """
+    Load a markdown file and find the templates of its theme.
+
+    :return: The document, the base template directory and the theme template directory
+    :raises click.ClickException: If the file or the theme does not exist
+    """
     if not os.path.exists(md):
-        click.echo(f"Error: Markdown file '{md}' does not exist.", err=True)
-        raise click.Abort()
-    
-    if not output:
-        output = tempfile.mkdtemp()
+        raise click.ClickException(f"Markdown file '{md}' does not exist.")
+
     template_dir = os.path.join(os.path.dirname(__file__), "templates")
-    options = read_options(md)
+    document = Document.load(md, disk_cache=disk_cache)
+    options = document.options
     base_template_dir = os.path.join(template_dir, "base")
     theme_template_dir = os.path.join(template_dir, options.theme)
-    
+
     if not os.path.exists(theme_template_dir):
-        click.echo(f"Error: Theme '{options.theme}' not found in templates directory.", err=True)
-        click.echo(f"Available themes: {', '.join(os.listdir(template_dir))}", err=True)
-        raise click.Abort()
-    render_handler = partial(
-        build,
-        document_path=md,
-        output_dir=output,
-        template_dir=base_template_dir,
-        theme_dir=theme_template_dir,
+        raise click.ClickException(
+            f"Theme '{options.theme}' not found in templates directory. "
+            f"Available themes: {', '.join(os.listdir(template_dir))}"
+        )
+    return document, base_template_dir, theme_template_dir
+
+
+def make_deck(md, output=None, cache_dir=None, jobs=1, asset_mode=None, progress=None):
+    """
+    Build the slides of a markdown file into output, a temporary directory if not given.
+
+    :return: Path of the generated html
+    """
+    disk_cache = DiskCache(cache_dir) if cache_dir else None
+    document, base_template_dir, theme_template_dir = load_deck(md, disk_cache)
+
+    # Temporary output only lives on this machine, so assets need not be real copies
+    if asset_mode is None:
+        asset_mode = "copy" if output else "auto"
+    if not output:
+        output = tempfile.mkdtemp()
+    build(
+        md,
+        output,
+        base_template_dir,
+        theme_template_dir,
+        cache_dir=cache_dir,
+        jobs=jobs,
+        document=document,
+        asset_mode=asset_mode,
+        progress=progress,
     )
+    return os.path.join(output, "index.html")
 
-    render_handler()
-    print(f"Generated html written to {os.path.join(output, 'index.html')}")
-    if live:
-        server = Server()
-        server.watch(md, render_handler)
-        server.watch(base_template_dir, render_handler)
-        if theme_template_dir:
-            server.watch(theme_template_dir, render_handler)
-        server.serve(root=output)
+
+def find_documents(patterns):
+    """
+    Expand markdown files, directories and glob patterns into markdown files.
+    Directories are searched recursively for .md files. Patterns matching nothing
+    are kept as they are, so that they are reported as missing.
+    """
+    documents = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            directory = glob.escape(pattern)
+            matches = glob.glob(os.path.join(directory, "**", "*.md"), recursive=True)
+        elif os.path.exists(pattern):
+            matches = [pattern]
+        else:
+            matches = glob.glob(pattern, recursive=True) or [pattern]
+        documents.extend(sorted(matches))
+
+    seen = set()
+    unique = []
+    for document in documents:
+        path = os.path.abspath(document)
+        if path not in seen:
+            seen.add(path)
+            unique.append(document)
+    return unique
+
+
+def deck_outputs(documents, output):
+    """
+    Output directory of each document. Several documents are put in subdirectories
+    of output named after their path, relative to the directory they all share.
+    The file name is kept whole, so decks never write into each other's directory:
+    a.md and a/b.md go to a.md/ and a/b.md/, and a.md and a.markdown stay apart.
+    """
+    if output is None:
+        return [None] * len(documents)
+    if len(documents) == 1:
+        return [output]
+    paths = [os.path.abspath(document) for document in documents]
+    common = os.path.commonpath([os.path.dirname(path) for path in paths])
+    outputs = [os.path.join(output, os.path.relpath(path, common)) for path in paths]
+    # Paths differing only in case are one directory on some file systems
+    seen = {}
+    for document, path in zip(documents, outputs):
+        other = seen.setdefault(os.path.normcase(path), document)
+        if other != document:
+            raise click.ClickException(
+                f"{other} and {document} would be written to the same directory."
+            )
+    return outputs
+
+
+def try_make_deck(md, output=None, cache_dir=None, asset_mode=None):
+    """make_deck for batches, returning (html path, None) or (None, error message)"""
+    try:
+        return make_deck(md, output, cache_dir, 1, asset_mode), None
+    except Exception as e:
+        return None, str(e) or repr(e)
+
+
+def make_all(documents, output=None, cache_dir=None, jobs=1, asset_mode=None):
+    """
+    Build many markdown files, `jobs` of them at a time in worker processes.
+    Workers keep their template environments and markdown converters across documents.
+
+    :return: (html path, None) or (None, error message) of each document, in order
+    """
+    outputs = deck_outputs(documents, output)
+    args = (documents, outputs, repeat(cache_dir), repeat(asset_mode))
+    if jobs == 1 or len(documents) == 1:
+        return list(map(try_make_deck, *args))
+    with ProcessPoolExecutor(max_workers=min(jobs, len(documents))) as executor:
+        return list(executor.map(try_make_deck, *args))
+
+
+def serve(md, document, template_dir, theme_dir, disk_cache=None, jobs=1):
+    """
+    Serve slides of a document from memory, updating them as files change.
+    Nothing is written to disk, assets are served from where they are.
+    """
+    # Builds run in a background thread, which worker processes must not be forked from
+    executor = None
+    if jobs > 1:
+        executor = ProcessPoolExecutor(
+            max_workers=jobs, mp_context=multiprocessing.get_context("spawn")
+        )
+    render = partial(
+        render_in_memory,
+        template_dir=template_dir,
+        theme_dir=theme_dir,
+        disk_cache=disk_cache,
+        jobs=jobs,
+        live=True,
+        executor=executor,
+    )
+    tree = OutputTree([theme_dir, template_dir])
+    server = LiveServer(tree)
+    # Remembers the slides last sent to the browser
+    patcher = SlidePatcher()
+    # Asset files watched so far
+    watched = set()
+
+    def update(html, assets):
+        tree.update(html, assets)
+        for source in assets:
+            if source not in watched:
+                watched.add(source)
+                server.watch(source, on_asset_change(source))
+
+    def rebuild(cancel):
+        # Runs in the background, re-paginating only around what changed
+        nonlocal document
+        with open(md, encoding="utf8") as f:
+            updated = document.update(f.read())
+        result = render(updated, cancel=cancel)
+        document = updated
+        return result
+
+    def refresh(result, reload):
+        # Send only the changed slides to the browser, unless it must reload
+        update(*result)
+        patch = patcher.update(tree.html)
+        push_patch(None if reload else patch)
+
+    rebuilder = Rebuilder(rebuild, refresh)
+
+    def on_change(reload=False):
+        def schedule():
+            rebuilder.schedule(reload)
+            # Browsers are refreshed once the build is done, not by livereload now
+            server.watcher.filepath = None
+
+        return schedule
+
+    def on_asset_change(source):
+        def refresh_asset():
+            # Only slides showing the asset are sent again, markdown is not rendered
+            if tree.refresh_asset(source):
+                push_patch(patcher.update(tree.html))
+            else:
+                rebuilder.schedule()
+            server.watcher.filepath = None
+
+        return refresh_asset
+
+    update(*render(document))
+    patcher.update(tree.html)
+    server.watch(md, on_change())
+    # Template changes reload the whole page
+    server.watch(template_dir, on_change(reload=True))
+    if theme_dir:
+        server.watch(theme_dir, on_change(reload=True))
+    try:
+        server.serve()
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
+def echo_progress(done, total):
+    """Show how many assets are copied, on one line"""
+    click.echo(f"\rCopying assets: {done}/{total}", nl=done == total, err=True)
 
 
 @click.group(
@@ -58,21 +256,79 @@ def cli():
     pass
 
 
+def cache_options(func):
+    """Options selecting the on-disk render cache"""
+    func = click.option(
+        "--no-cache",
+        is_flag=True,
+        default=False,
+        help="Do not read or write the on-disk render cache.",
+    )(func)
+    func = click.option(
+        "--cache-dir",
+        metavar="<cache-path>",
+        default=None,
+        help=(
+            "Directory of the on-disk render cache. Defaults to $MOFFEE_CACHE_DIR "
+            "or the user cache directory. Cached pages are pickled, so it must "
+            "only be writable by trusted users."
+        ),
+    )(func)
+    return func
+
+
+def jobs_option(func):
+    """Option selecting the number of markdown worker processes"""
+    return click.option(
+        "-j",
+        "--jobs",
+        metavar="<n>",
+        type=click.IntRange(min=1),
+        default=os.cpu_count() or 1,
+        show_default="number of CPUs",
+        help="Number of worker processes. Several documents are built in parallel, a single one has its markdown converted in parallel. Small documents are always converted in-process.",
+    )(func)
+
+
+def assets_option(func):
+    """Option selecting how assets are put into the output directory"""
+    return click.option(
+        "--assets",
+        "asset_mode",
+        type=click.Choice(ASSET_MODES),
+        default=None,
+        show_default="auto for temporary output, copy otherwise",
+        help="How referenced files are put into the output. Unsupported modes fall back to copy, auto picks the cheapest that works.",
+    )(func)
+
+
+def resolve_cache_dir(cache_dir, no_cache):
+    if no_cache:
+        return None
+    return cache_dir or default_cache_dir()
+
+
 @cli.command(
     help="""
-Generate slides from a markdown file.
+Generate slides from markdown files.
 
 This command takes a markdown file as input and produces a set of slides
 formatted as an HTML file. You can specify an output directory where the
 HTML will be saved.
 
+Several files, directories and glob patterns may be given to build many
+decks at once. Each deck is then written to a subdirectory of the output
+directory named after its path, e.g. output/talks/intro.md/index.html,
+and a summary is printed at the end.
+
 Example usage:
 
 \b
   python moffee.py make example.md -o output/
+  python moffee.py make decks/ "talks/**/*.md" -o output/ -j 8
 """
 )
-@click.argument("markdown", metavar="<markdown-file>")
+@click.argument("markdown", metavar="<markdown-file>...", nargs=-1, required=True)
 @click.option(
     "-o",
     "--output",
@@ -80,9 +336,37 @@ Example usage:
     default=None,
     help="Output file path. If not specified, a temporary directory will be used.",
 )
-def make(markdown, output):
-    """Generate slides from a markdown file."""
-    run(markdown, output, live=False)
+@cache_options
+@jobs_option
+@assets_option
+def make(markdown, output, cache_dir, no_cache, jobs, asset_mode):
+    """Generate slides from markdown files."""
+    cache_dir = resolve_cache_dir(cache_dir, no_cache)
+    documents = find_documents(markdown)
+    if not documents:
+        raise click.ClickException("No markdown files found.")
+    if len(markdown) == 1 and len(documents) == 1:
+        run(
+            documents[0],
+            output,
+            live=False,
+            cache_dir=cache_dir,
+            jobs=jobs,
+            asset_mode=asset_mode,
+        )
+        return
+
+    results = make_all(documents, output, cache_dir, jobs, asset_mode)
+    failed = 0
+    for md, (output_file, error) in zip(documents, results):
+        if error is None:
+            click.echo(f"ok      {md} -> {output_file}")
+        else:
+            failed += 1
+            click.echo(f"failed  {md}: {error}", err=True)
+    click.echo(f"{len(documents) - failed} built, {failed} failed")
+    if failed:
+        raise click.exceptions.Exit(1)
 
 
 @cli.command(
@@ -100,9 +384,48 @@ Example usage:
 """
 )
 @click.argument("markdown", metavar="<markdown-file>")
-def live(markdown):
+@cache_options
+@jobs_option
+def live(markdown, cache_dir, no_cache, jobs):
     """Launch live mode to update html outputs."""
-    run(markdown, output=None, live=True)
+    run(
+        markdown,
+        output=None,
+        live=True,
+        cache_dir=resolve_cache_dir(cache_dir, no_cache),
+        jobs=jobs,
+    )
+
+
+@cli.group(
+    help="""
+Inspect or clear the on-disk render cache.
+
+Rendered chunks and parsed pages are cached across runs, so rebuilding
+an unchanged document skips the markdown conversion.
+"""
+)
+def cache():
+    pass
+
+
+@cache.command(help="Show location and size of the render cache.")
+@click.option("--cache-dir", metavar="<cache-path>", default=None)
+def info(cache_dir):
+    stats = DiskCache(cache_dir or default_cache_dir()).stats()
+    click.echo(f"Cache directory: {stats['path']}")
+    click.echo(f"Entries: {stats['entries']}")
+    used = stats["bytes"] / 1024 / 1024
+    limit = stats["max_bytes"] / 1024 / 1024
+    click.echo(f"Size: {used:.1f} MiB / {limit:.0f} MiB")
+
+
+@cache.command(help="Delete every entry of the render cache.")
+@click.option("--cache-dir", metavar="<cache-path>", default=None)
+def clear(cache_dir):
+    disk_cache = DiskCache(cache_dir or default_cache_dir())
+    disk_cache.clear()
+    click.echo(f"Cleared {disk_cache.root}")
 
 
 if __name__ == "__main__":
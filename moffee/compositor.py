@@ -1,27 +1,37 @@
-from dataclasses import dataclass, field, fields
-from typing import List, Optional, Tuple, Dict, Any
-from copy import deepcopy
+from bisect import bisect_left
+from copy import copy
+from dataclasses import InitVar, dataclass, field, fields, replace
+from itertools import chain, islice
+from typing import Iterable, Iterator, List, Optional, TextIO, Tuple, Dict, Any
+import io
 import yaml
 import re
-from moffee.utils.md_helper import (
-    get_header_level,
-    is_divider,
-    is_empty,
-    rm_comments,
-    contains_deco,
-)
+from moffee.utils.md_helper import iter_rm_comments
 
 # Pre-compiled regex patterns for better performance
 ASPECT_RATIO_PATTERN = re.compile(r"([0-9]+):([0-9]+)")
 KEY_VALUE_PATTERN = re.compile(r'([\w-]+)\s*=\s*((?:"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'|[^,]+))')
+# Everything the compositor needs to know about a line, in one match.
+# Mirrors get_header_level, is_divider, contains_deco and is_comment in md_helper.
+LINE_PATTERN = re.compile(
+    r"^(?:(?P<header>#{1,6})\s"
+    r"|\s*(?:(?P<divider>\*{3,}|-{3,}|_{3,}|<->|={3,})|(?P<deco>@\(.*?\))|(?P<comment><!--.*-->))\s*$"
+    r"|\s*(?P<fence>```))"
+)
 
 DEFAULT_ASPECT_RATIO = "16:9"
 DEFAULT_SLIDE_WIDTH = 720
 DEFAULT_SLIDE_HEIGHT = 405
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class PageOption:
+    """
+    Options of a page. Immutable, so pages and decos share one instance
+    until a deco overrides something, see parse_deco.
+    styles is shared as well and must not be modified in place.
+    """
+
     default_h1: bool = False
     default_h2: bool = True
     default_h3: bool = True
@@ -63,6 +73,9 @@ class PageOption:
         return width, height
 
 
+OPTION_FIELDS = frozenset(f.name for f in fields(PageOption))
+
+
 class Direction:
     HORIZONTAL = "horizontal"
     VERTICAL = "vertical"
@@ -80,25 +93,180 @@ class Alignment:
     JUSTIFY = "justify"
 
 
-@dataclass
+@dataclass(slots=True)
+class LineToken:
+    """
+    Classification of a single markdown line.
+
+    :ivar text: The line itself
+    :ivar header_level: Header level 1-6, 0 if not a header
+    :ivar divider: Divider kind "-", "=", "<", "*" or "_", None if not a divider
+    :ivar deco: Whether the line is a deco
+    :ivar comment: Whether the line is a html comment
+    :ivar blank: Whether the line is whitespace only
+    :ivar fence: Whether the line opens or closes a code block
+    :ivar escaped: Whether the line is inside a code block, fences included
+    """
+
+    text: str
+    header_level: int = 0
+    divider: Optional[str] = None
+    deco: bool = False
+    comment: bool = False
+    blank: bool = False
+    fence: bool = False
+    escaped: bool = False
+
+    @property
+    def empty(self) -> bool:
+        """Same as md_helper.is_empty"""
+        return self.blank or self.comment
+
+
+def tokenize(lines: Iterable[str]) -> Iterator[LineToken]:
+    """
+    Classify every line once, tracking code blocks along the way.
+    Header levels and dividers are reported even inside code blocks, check `escaped` to skip them.
+
+    :param lines: Lines of markdown, without line breaks
+    :return: Iterator of one LineToken per line
+    """
+    escaped = False
+    for line in lines:
+        match = LINE_PATTERN.match(line)
+        if match is None:
+            yield LineToken(line, blank=not line.strip(), escaped=escaped)
+            continue
+        header, divider, deco, comment, fence = match.group(
+            "header", "divider", "deco", "comment", "fence"
+        )
+        if fence:
+            escaped = not escaped
+        yield LineToken(
+            line,
+            header_level=len(header) if header else 0,
+            divider=divider[0] if divider else None,
+            deco=deco is not None,
+            comment=comment is not None,
+            fence=fence is not None,
+            escaped=escaped,
+        )
+
+
+# Stands in for the line break prepended to page text
+BLANK_TOKEN = LineToken("", blank=True)
+
+
+def split_lines(
+    tokens: List[LineToken], start: int, end: int, divider: str
+) -> List[Tuple[int, int]]:
+    """
+    Split the lines tokens[start:end] at dividers of the given kind outside code blocks.
+
+    :return: (start, end) line ranges between the dividers
+    """
+    ranges = []
+    escaped = False
+    group_start = start
+    for i in range(start, end):
+        token = tokens[i]
+        if token.fence:
+            escaped = not escaped
+        if token.divider == divider and not escaped:
+            ranges.append((group_start, i))
+            group_start = i + 1
+    ranges.append((group_start, end))
+    return ranges
+
+
+@dataclass(slots=True)
 class Chunk:
-    paragraph: Optional[str] = None
-    children: Optional[List["Chunk"]] = field(default_factory=list)  # List of chunks
+    """
+    Node of a page's chunk tree.
+    Paragraph chunks keep offsets into the page text instead of a copy of their paragraph.
+    """
+
+    source: Optional[str] = field(default=None, repr=False)
+    start: int = 0
+    end: int = 0
+    children: Tuple["Chunk", ...] = ()
     direction: Direction = Direction.HORIZONTAL
     type: Type = Type.PARAGRAPH
     alignment: Alignment = Alignment.LEFT
 
+    @property
+    def paragraph(self) -> Optional[str]:
+        if self.source is None:
+            return None
+        return self.source[self.start : self.end]
+
 
-@dataclass
+def build_chunk(tokens: List[LineToken], source: str) -> Chunk:
+    """
+    Split page text into chunk tree
+    Chunk tree branches when in-page divider is met.
+    - adjacent "<->"s create chunk with horizontal direction
+    - adjacent "===" create chunk with vertical direction
+    "===" possesses higher priority than "<->"
+
+    :param tokens: Tokens of the lines of source
+    :param source: Page text, the lines of tokens joined by line breaks
+    :return: Root of the chunk tree
+    """
+    offsets = []
+    offset = 0
+    for token in tokens:
+        offsets.append(offset)
+        offset += len(token.text) + 1
+
+    def paragraph(start: int, end: int) -> Chunk:
+        if start == end:
+            return Chunk(source=source)
+        last = tokens[end - 1]
+        return Chunk(
+            source=source, start=offsets[start], end=offsets[end - 1] + len(last.text)
+        )
+
+    # collect "==="
+    vchunks = []
+    for vstart, vend in split_lines(tokens, 0, len(tokens), "="):
+        # split by "<->" if possible
+        hranges = split_lines(tokens, vstart, vend, "<")
+        if len(hranges) > 1:  # found <->
+            hchunks = tuple(paragraph(start, end) for start, end in hranges)
+            vchunks.append(Chunk(children=hchunks, type=Type.NODE))
+        else:
+            vchunks.append(paragraph(vstart, vend))
+
+    if len(vchunks) == 1:
+        return vchunks[0]
+
+    return Chunk(children=tuple(vchunks), direction=Direction.VERTICAL, type=Type.NODE)
+
+
+@dataclass(slots=True)
 class Page:
     raw_md: str
     option: PageOption
     h1: Optional[str] = None
     h2: Optional[str] = None
     h3: Optional[str] = None
-
-    def __post_init__(self):
-        self._preprocess()
+    # Range of content lines the page was built from, including its closing divider
+    start: int = 0
+    end: int = 0
+    # Tokens of raw_md lines, tokenized from raw_md if not given
+    tokens: InitVar[Optional[List[LineToken]]] = None
+    _chunk: Optional[Chunk] = field(default=None, init=False, repr=False, compare=False)
+    # Headings declared on the page itself, before inheritance
+    _headings: Tuple[Optional[str], Optional[str], Optional[str]] = field(
+        default=(None, None, None), init=False, repr=False, compare=False
+    )
+    # Level of the header directly before the page, where pagination resumes
+    _entry_level: int = field(default=0, init=False, repr=False, compare=False)
+
+    def __post_init__(self, tokens: Optional[List[LineToken]]):
+        self._headings = (self.h1, self.h2, self.h3)
+        self._preprocess(tokens)
 
     @property
     def title(self) -> Optional[str]:
@@ -115,52 +283,37 @@ class Page:
     @property
     def chunk(self) -> Chunk:
         """
-        Split raw_md into chunk tree
-        Chunk tree branches when in-page divider is met.
-        - adjacent "<->"s create chunk with horizontal direction
-        - adjacent "===" create chunk with vertical direction
-        "===" possesses higher priority than "<->"
-
-        :return: Root of the chunk tree
+        Root of the chunk tree, see build_chunk.
+        Built once when the page is created.
         """
+        return self._chunk
 
-        def split_by_div(text, type) -> List[Chunk]:
-            strs = [""]
-            current_escaped = False
-            for line in text.split("\n"):
-                if line.strip().startswith("```"):
-                    current_escaped = not current_escaped
-                if is_divider(line, type) and not current_escaped:
-                    strs.append("\n")
-                else:
-                    strs[-1] += line + "\n"
-            return [Chunk(paragraph=s) for s in strs]
-
-        # collect "==="
-        vchunks = split_by_div(self.raw_md, "=")
-        # split by "<->" if possible
-        for i in range(len(vchunks)):
-            hchunks = split_by_div(vchunks[i].paragraph, "<")
-            if len(hchunks) > 1:  # found <->
-                vchunks[i] = Chunk(children=hchunks, type=Type.NODE)
-
-        if len(vchunks) == 1:
-            return vchunks[0]
-
-        return Chunk(children=vchunks, direction=Direction.VERTICAL, type=Type.NODE)
-
-    def _preprocess(self):
+    def _preprocess(self, tokens: Optional[List[LineToken]] = None):
         """
         Additional processing needed for the page.
         Modifies raw_md in place.
 
         - Removes headings 1-3
         - Stripes
+        - Builds the chunk tree
         """
 
-        lines = self.raw_md.splitlines()
-        lines = [l for l in lines if not (1 <= get_header_level(l) <= 3)]
-        self.raw_md = "\n".join(lines).strip()
+        if tokens is None:
+            tokens = tokenize(self.raw_md.split("\n"))
+        tokens = [t for t in tokens if not (1 <= t.header_level <= 3)]
+
+        # Strip, keeping tokens in line with raw_md
+        start, end = 0, len(tokens)
+        while start < end and tokens[start].blank:
+            start += 1
+        while end > start and tokens[end - 1].blank:
+            end -= 1
+        tokens = tokens[start:end] or [BLANK_TOKEN]
+        tokens[0] = replace(tokens[0], text=tokens[0].text.lstrip())
+        tokens[-1] = replace(tokens[-1], text=tokens[-1].text.rstrip())
+
+        self.raw_md = "\n".join([t.text for t in tokens])
+        self._chunk = build_chunk(tokens, self.raw_md)
 
 
 def parse_frontmatter(document: str) -> Tuple[str, PageOption]:
@@ -181,6 +334,16 @@ def parse_frontmatter(document: str) -> Tuple[str, PageOption]:
             front_matter = parts[1].strip()
             content = parts[2].strip()
 
+    return content, parse_options(front_matter)
+
+
+def parse_options(front_matter: str) -> PageOption:
+    """
+    Create the document-wide PageOption from YAML front matter.
+
+    :param front_matter: YAML text between the front matter delimiters, may be empty
+    :return: The PageOption, with unknown keys as styles
+    """
     # Parse YAML front matter
     try:
         yaml_data = yaml.safe_load(front_matter) if front_matter else {}
@@ -188,14 +351,64 @@ def parse_frontmatter(document: str) -> Tuple[str, PageOption]:
         yaml_data = {}
 
     # Create PageOption from YAML data
-    option = PageOption()
-    for field in fields(option):
+    values = {}
+    for field in fields(PageOption):
         name = field.name
         if name in yaml_data:
-            setattr(option, name, yaml_data.pop(name))
-    option.styles = yaml_data
+            values[name] = yaml_data.pop(name)
+    values["styles"] = yaml_data
+    return PageOption(**values)
+
+
+def read_frontmatter(lines: Iterable[str]) -> Tuple[PageOption, Iterator[str]]:
+    """
+    Streaming version of parse_frontmatter.
+    Only the front matter is read right away, the content is read as the returned iterator advances.
 
-    return content, option
+    :param lines: Lines of the document, without line breaks
+    :return: A tuple containing the PageOption and an iterator of the stripped content lines
+    """
+    lines = _strip_lines(lines)
+    first = next(lines, None)
+    if first is None or not first.startswith("---"):
+        content = chain([first], lines) if first is not None else lines
+        return parse_options(""), content
+
+    # Like str.split, the closing "---" may be anywhere after the opening one
+    read = [first]
+    end = first.find("---", 3)
+    while end < 0:
+        line = next(lines, None)
+        if line is None:
+            # No closing "---", so there is no front matter
+            return parse_options(""), iter(read)
+        read.append(line)
+        end = line.find("---")
+
+    text = "\n".join(read)
+    end += len(text) - len(read[-1])
+    front_matter = text[3:end].strip()
+    return parse_options(front_matter), _strip_lines(chain([text[end + 3 :]], lines))
+
+
+def _strip_lines(lines: Iterable[str]) -> Iterator[str]:
+    """Lines of "\n".join(lines).strip(), holding back only trailing whitespace-only lines"""
+    last = None
+    blanks: List[str] = []
+    for line in lines:
+        if not line.strip():
+            if last is not None:
+                blanks.append(line)
+            continue
+        if last is None:
+            line = line.lstrip()
+        else:
+            yield last
+            yield from blanks
+            blanks.clear()
+        last = line
+    if last is not None:
+        yield last.rstrip()
 
 
 def parse_deco(line: str, base_option: Optional[PageOption] = None) -> PageOption:
@@ -231,15 +444,20 @@ def parse_deco(line: str, base_option: Optional[PageOption] = None) -> PageOptio
     if base_option is None:
         base_option = PageOption()
 
-    updated_option = deepcopy(base_option)
-
+    # Only allocate what the deco overrides, everything else is shared with base_option
+    overrides = {}
+    styles = {}
     for key, value in deco.items():
-        if hasattr(updated_option, key):
-            setattr(updated_option, key, parse_value(value))
+        if key in OPTION_FIELDS:
+            overrides[key] = parse_value(value)
         else:
-            updated_option.styles[key] = parse_value(value)
+            styles[key] = parse_value(value)
+    if styles:
+        overrides["styles"] = {**base_option.styles, **styles}
+    if not overrides:
+        return base_option
 
-    return updated_option
+    return replace(base_option, **overrides)
 
 
 def parse_value(value: str):
@@ -264,53 +482,93 @@ def composite(document: str) -> List[Page]:
     - "---" Divider (===, <->, +++ not count)
 
     :param document: Input markdown document as a string.
-    :param document_path: Optional string, will be used to redirect url in documents if given.
     :return: List of Page objects representing paginated slides
     """
-    pages: List[Page] = []
-    current_page_lines = []
-    current_escaped = False  # track whether in code area
-    current_h1 = current_h2 = current_h3 = None
-    prev_header_level = 0
+    return list(iter_pages(io.StringIO(document)))
 
-    document = rm_comments(document)
-    document, options = parse_frontmatter(document)
 
-    lines = document.split("\n")
+def iter_pages(file: TextIO) -> Iterator[Page]:
+    """
+    Composite a markdown document read from a file into slide pages, see composite.
+    Each page is yielded as soon as the line ending it is read, so only about one page
+    is held in memory at a time.
+
+    :param file: Text file object of the document, or any other iterable of its lines
+    :return: Iterator of Page objects representing paginated slides
+    """
+    lines = (line[:-1] if line.endswith("\n") else line for line in file)
+    options, content = read_frontmatter(iter_rm_comments(lines))
+    yield from inherit_headings(iter_raw_pages(tokenize(content), options))
+
+
+def paginate(content: str, options: PageOption) -> List[Page]:
+    """
+    Split document content, with comments and front matter already removed, into slide pages.
 
-    def create_page():
-        nonlocal current_page_lines, current_h1, current_h2, current_h3, options
+    :param content: Markdown content of the document
+    :param options: Document-wide options from the front matter
+    :return: List of Page objects representing paginated slides
+    """
+    pages = iter_raw_pages(tokenize(content.split("\n")), options)
+    return list(inherit_headings(pages))
+
+
+def iter_raw_pages(
+    tokens: Iterable[LineToken],
+    options: PageOption,
+    first_line: int = 0,
+    prev_header_level: int = 0,
+) -> Iterator[Page]:
+    """
+    Split tokenized lines into pages, before headings are inherited.
+    Pagination can resume at the start of any page, given the line it starts at and its entry level.
+
+    :param tokens: Tokens of the content lines, from `first_line` on
+    :param options: Document-wide options from the front matter
+    :param first_line: Index of the first token's line in the content
+    :param prev_header_level: Level of the header directly before `first_line`, 0 if none
+    :return: Iterator of pages, with their line ranges set
+    """
+    current_page_tokens: List[LineToken] = []
+    current_h1 = current_h2 = current_h3 = None
+    current_start = end_line = first_line
+    entry_level = prev_header_level
+
+    def create_page(end: int) -> Optional[Page]:
+        nonlocal current_page_tokens, current_h1, current_h2, current_h3
         # Only make new page if has non empty lines
 
-        if all(l.strip() == "" for l in current_page_lines):
-            return
+        if all(t.blank for t in current_page_tokens):
+            return None
 
-        raw_md = ""
-        local_option = deepcopy(options)
-        for line in current_page_lines:
-            if contains_deco(line):
-                local_option = parse_deco(line, local_option)
+        page_tokens = [BLANK_TOKEN]
+        local_option = options
+        for token in current_page_tokens:
+            if token.deco:
+                local_option = parse_deco(token.text, local_option)
             else:
-                raw_md += "\n" + line
+                page_tokens.append(token)
 
         page = Page(
-            raw_md=raw_md,
+            raw_md="\n".join([t.text for t in page_tokens]),
             option=local_option,
             h1=current_h1,
             h2=current_h2,
             h3=current_h3,
+            start=current_start,
+            end=end,
+            tokens=page_tokens,
         )
+        page._entry_level = entry_level
 
-        pages.append(page)
-        current_page_lines = []
+        current_page_tokens = []
         current_h1 = current_h2 = current_h3 = None
+        return page
 
-    for _, line in enumerate(lines):
-        # update current env stack
-        if line.strip().startswith("```"):
-            current_escaped = not current_escaped
-
-        header_level = get_header_level(line) if not current_escaped else 0
+    for i, token in enumerate(tokens, start=first_line):
+        line = token.text
+        end_line = i + 1
+        header_level = token.header_level if not token.escaped else 0
 
         # Check if this is a new header and not consecutive
         # Only break at heading 1-3
@@ -320,13 +578,21 @@ def composite(document: str) -> List[Page]:
         is_more_than_level_4 = prev_header_level > header_level >= 3
         if header_level > 0 and is_downstep_header_level and not is_more_than_level_4:
             # Check if the next line is also a header
-            create_page()
-
-        if is_divider(line, type="-") and not current_escaped:
-            create_page()
+            page = create_page(end=i)
+            if page:
+                yield page
+            if not current_page_tokens:
+                current_start, entry_level = i, prev_header_level
+
+        if token.divider == "-" and not token.escaped:
+            page = create_page(end=i + 1)
+            if page:
+                yield page
+            if not current_page_tokens:
+                current_start, entry_level = i + 1, prev_header_level
             continue
 
-        current_page_lines.append(line)
+        current_page_tokens.append(token)
 
         if header_level == 1:
             current_h1 = line.lstrip("#").strip()
@@ -339,15 +605,23 @@ def composite(document: str) -> List[Page]:
 
         if header_level > 0:
             prev_header_level = header_level
-        if header_level == 0 and not is_empty(line) and not contains_deco(line):
+        if header_level == 0 and not token.empty and not token.deco:
             prev_header_level = 0
 
     # Create the last page if there's remaining content
-    create_page()
+    page = create_page(end=end_line)
+    if page:
+        yield page
+
 
-    # Process each page and choose titles
+def inherit_headings(pages: Iterable[Page]) -> Iterator[Page]:
+    """
+    Fill in headings each page inherits from the pages before it, following default_h1/h2/h3.
+    Starts over from the headings declared on each page, so pages can be passed again.
+    """
     env_h1 = env_h2 = env_h3 = None
     for page in pages:
+        page.h1, page.h2, page.h3 = page._headings
         inherit_h1 = page.option.default_h1
         inherit_h2 = page.option.default_h2
         inherit_h3 = page.option.default_h3
@@ -368,5 +642,89 @@ def composite(document: str) -> List[Page]:
             page.h2 = env_h2
         if inherit_h3:
             page.h3 = env_h3
+        yield page
+
+
+@dataclass
+class LineEdit:
+    """
+    Replacement of the content lines [start, end) with new lines.
+    """
 
-    return pages
+    start: int
+    end: int
+    lines: List[str]
+
+    @property
+    def delta(self) -> int:
+        """Change in line count"""
+        return len(self.lines) - (self.end - self.start)
+
+
+def diff_lines(old: List[str], new: List[str]) -> LineEdit:
+    """Smallest single edit turning old lines into new lines, found by trimming the common prefix and suffix"""
+    prefix = 0
+    limit = min(len(old), len(new))
+    while prefix < limit and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    while (
+        suffix < limit - prefix
+        and old[len(old) - 1 - suffix] == new[len(new) - 1 - suffix]
+    ):
+        suffix += 1
+    return LineEdit(
+        start=prefix, end=len(old) - suffix, lines=new[prefix : len(new) - suffix]
+    )
+
+
+def repaginate(
+    pages: List[Page], content: str, options: PageOption, edit: LineEdit
+) -> List[Page]:
+    """
+    Paginate content again after an edit, reusing the pages outside the edited range.
+    Pagination restarts at the last page starting before the edit, and stops as soon as
+    a page starts where an old page after the edit started in the same state.
+    The result equals paginate(content, options), previous pages are left untouched.
+
+    :param pages: Pages of the content before the edit, as returned by paginate
+    :param content: Content after the edit
+    :param options: Document-wide options, must be the ones pages were built with
+    :param edit: The edit, in old content line numbers
+    :return: List of Page objects representing paginated slides
+    """
+    # Restart from the last page starting strictly before the edit, since
+    # the edit may turn the line a page starts at into something else
+    starts = [page.start for page in pages]
+    restart = bisect_left(starts, edit.start) - 1
+    if restart < 0:
+        return paginate(content, options)
+
+    # Old pages that may be resumed from, by their start in new line numbers
+    resumable = {
+        page.start + edit.delta: i
+        for i, page in enumerate(pages)
+        if page.start >= edit.end
+    }
+
+    lines = content.split("\n")
+    first = pages[restart]
+    new_pages = []
+    for page in iter_raw_pages(
+        tokenize(islice(lines, first.start, None)),
+        options,
+        first_line=first.start,
+        prev_header_level=first._entry_level,
+    ):
+        i = resumable.get(page.start)
+        if i is not None and pages[i]._entry_level == page._entry_level:
+            for old in pages[i:]:
+                old = copy(old)
+                old.start += edit.delta
+                old.end += edit.delta
+                new_pages.append(old)
+            break
+        new_pages.append(page)
+
+    unchanged = [copy(page) for page in pages[:restart]]
+    return list(inherit_headings(unchanged + new_pages))
@@ -0,0 +1,272 @@
+import json
+import mimetypes
+import os
+import re
+import warnings
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Event
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from urllib.parse import quote, unquote
+
+from livereload import Server
+from livereload.handlers import LiveReloadHandler
+from tornado import web
+from tornado.ioloop import IOLoop
+
+from moffee.builder import STREAM_BLOCK_SIZE, TEMPLATE_ENTRIES, BuildCancelled
+from moffee.utils.file_helper import asset_name, rewrite_urls
+
+# Reload paths starting with this carry a slide patch instead of a file path
+PATCH_PREFIX = "moffee-slides:"
+
+SLIDE_PATTERN = re.compile(r"<div\b[^>]*\bdata-slide-id=\"(?P<id>[^\"]*)\"[^>]*>")
+# Seconds without changes before a build starts
+DEBOUNCE_DELAY = 0.2
+
+# Comments are matched so that divs inside them are not counted
+DIV_PATTERN = re.compile(r"<!--.*?-->|<div\b[^>]*>|</div\s*>", re.DOTALL)
+
+
+def split_slides(html: str) -> Tuple[str, List[Tuple[str, str]]]:
+    """
+    Cut the slides out of a rendered page.
+
+    :param html: Page rendered from a template marking slides with data-slide-id
+    :return: The page without its slides, and the (id, html) of every slide in order
+    """
+    shell = []
+    slides = []
+    pos = 0
+    while match := SLIDE_PATTERN.search(html, pos):
+        depth = 1
+        end = len(html)
+        for tag in DIV_PATTERN.finditer(html, match.end()):
+            if tag.group().startswith("</"):
+                depth -= 1
+            elif not tag.group().startswith("<!--"):
+                depth += 1
+            if depth == 0:
+                end = tag.end()
+                break
+        shell.append(html[pos : match.start()])
+        slides.append((match.group("id"), html[match.start() : end]))
+        pos = end
+    shell.append(html[pos:])
+    return "".join(shell), slides
+
+
+class SlidePatcher:
+    """
+    Remembers the slides of the last build to tell which ones a new build changed.
+    """
+
+    def __init__(self):
+        self.shell: Optional[str] = None
+        self.slides: Dict[str, str] = {}
+
+    def update(self, html: str) -> Optional[dict]:
+        """
+        Compare a newly rendered page with the last one.
+
+        :param html: The new page
+        :return: Patch with the new order of slide ids and the html of changed slides,
+            or None if anything outside the slides changed and the page must be reloaded
+        """
+        shell, slides = split_slides(html)
+        patch = None
+        if shell == self.shell:
+            patch = {
+                "order": [slide_id for slide_id, _ in slides],
+                "slides": {
+                    slide_id: slide
+                    for slide_id, slide in slides
+                    if self.slides.get(slide_id) != slide
+                },
+            }
+        self.shell, self.slides = shell, dict(slides)
+        return patch
+
+
+def push_patch(patch: Optional[dict]):
+    """Send a patch to every connected browser, or reload them if there is none"""
+    if patch is None:
+        LiveReloadHandler.reload_waiters()
+    else:
+        LiveReloadHandler.reload_waiters(PATCH_PREFIX + json.dumps(patch))
+
+
+class Rebuilder:
+    """
+    Runs builds in a background thread once changes settle, keeping the server responsive.
+    Changes less than `delay` seconds apart are coalesced into one build,
+    and a running build made stale by a newer change is cancelled.
+
+    :param build: Called in the background thread with an Event set on cancellation,
+        should raise BuildCancelled once it is set
+    :param done: Called on the server loop with the result of every build not cancelled,
+        and whether the page must be reloaded instead of patched
+    :param delay: Debounce window in seconds
+    """
+
+    def __init__(
+        self,
+        build: Callable[[Event], Any],
+        done: Callable[[Any, bool], None],
+        delay: float = DEBOUNCE_DELAY,
+    ):
+        self.build = build
+        self.done = done
+        self.delay = delay
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self._timer = None
+        self._reload = False
+        self._cancel: Optional[Event] = None
+        self._running_reload = False
+
+    def schedule(self, reload: bool = False):
+        """Request a build, call from the server loop"""
+        loop = IOLoop.current()
+        self._reload = self._reload or reload
+        if self._cancel is not None and not self._cancel.is_set():
+            # The running build is stale, the next one takes over its reload
+            self._cancel.set()
+            self._reload = self._reload or self._running_reload
+        if self._timer is not None:
+            loop.remove_timeout(self._timer)
+        self._timer = loop.call_later(self.delay, self._start, loop)
+
+    def _start(self, loop: IOLoop):
+        self._timer = None
+        cancel = Event()
+        self._cancel = cancel
+        self._running_reload, self._reload = self._reload, False
+        future = self.executor.submit(self.build, cancel)
+        future.add_done_callback(
+            lambda future: loop.add_callback(self._finish, future, cancel)
+        )
+
+    def _finish(self, future: Future, cancel: Event):
+        if cancel.is_set():
+            return
+        self._cancel = None
+        error = future.exception()
+        if isinstance(error, BuildCancelled):
+            return
+        if error is not None:
+            warnings.warn(
+                f"Build failed, serving the last output: {error!r}", stacklevel=2
+            )
+            self._reload = self._reload or self._running_reload
+            return
+        self.done(future.result(), self._running_reload)
+
+
+class OutputTree:
+    """
+    Output directory of live mode, kept in memory instead of written to disk.
+    Generated files are held as bytes, assets are read from where they are
+    and static files from the template directories.
+
+    :param static_dirs: Template directories, the first one containing a file wins
+    """
+
+    def __init__(self, static_dirs: List[str]):
+        self.static_dirs = static_dirs
+        self.html = ""
+        self.files: Dict[str, bytes] = {}
+        # Path in the output of each asset file, and the other way round
+        self.assets: Dict[str, str] = {}
+        self._sources: Dict[str, str] = {}
+
+    def update(self, html: str, assets: Dict[str, str]):
+        """Replace the output with a new render, see builder.render_in_memory"""
+        self.html = html
+        self.files = {"index.html": html.encode("utf-8")}
+        self.assets = dict(assets)
+        self._sources = {name: source for source, name in assets.items()}
+
+    def refresh_asset(self, source: str) -> bool:
+        """
+        Point the html at the new content of an asset file, without rendering again.
+
+        :param source: Asset file that changed
+        :return: False if the document has to be rendered again instead,
+            because the file is gone or shares its name with another file
+        """
+        name = self.assets.get(source)
+        if name is None:
+            return True
+        if not os.path.isfile(source):
+            return False
+        if list(self.assets.values()).count(name) > 1:
+            return False
+        new_name = f"assets/{asset_name(source)}"
+        if new_name == name:
+            return True
+
+        def rewrite(url):
+            return quote(new_name) if unquote(url) == name else url
+
+        assets = dict(self.assets)
+        assets[source] = new_name
+        self.update(rewrite_urls(self.html, rewrite), assets)
+        return True
+
+    def resolve(self, path: str) -> Union[bytes, str, None]:
+        """
+        Find what is served at a path of the output.
+
+        :param path: Path relative to the output root
+        :return: Content of a generated file, path of a file on disk, or None if not found
+        """
+        parts = [part for part in path.split("/") if part not in ("", ".")]
+        if ".." in parts:
+            return None
+        path = "/".join(parts) or "index.html"
+        if path in self.files:
+            return self.files[path]
+        if path in self._sources:
+            return self._sources[path]
+        if parts[0] in TEMPLATE_ENTRIES:
+            return None
+        for static_dir in self.static_dirs:
+            candidate = os.path.join(static_dir, *parts)
+            if os.path.isfile(candidate):
+                return candidate
+        return None
+
+
+class OutputHandler(web.RequestHandler):
+    """Serves an OutputTree"""
+
+    def initialize(self, tree: OutputTree):
+        self.tree = tree
+
+    async def get(self, path: str):
+        target = self.tree.resolve(path)
+        if target is None:
+            raise web.HTTPError(404)
+        content_type, _ = mimetypes.guess_type(path or "index.html")
+        self.set_header("Content-Type", content_type or "application/octet-stream")
+        self.set_header("Cache-Control", "no-cache")
+        if isinstance(target, bytes):
+            self.write(target)
+            return
+        try:
+            with open(target, "rb") as f:
+                for block in iter(lambda: f.read(STREAM_BLOCK_SIZE), b""):
+                    self.write(block)
+                    await self.flush()
+        except FileNotFoundError:
+            raise web.HTTPError(404)
+
+
+class LiveServer(Server):
+    """Livereload server serving an OutputTree instead of a directory"""
+
+    def __init__(self, tree: OutputTree):
+        super().__init__()
+        self.tree = tree
+
+    def get_web_handlers(self, script):
+        return [(r"/(.*)", OutputHandler, {"tree": self.tree})]
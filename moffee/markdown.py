@@ -1,6 +1,13 @@
-from markdown import markdown
+from concurrent.futures import Executor, ProcessPoolExecutor
+from contextlib import contextmanager
+import hashlib
+from threading import Lock
+from typing import Any, Dict, Iterator, List, Optional
+
+from markdown import Markdown
 from markupsafe import Markup
 import pymdownx.superfences
+from moffee.utils.cache import DiskCache, RenderCache, content_key
 
 extensions = [
     "pymdownx.tasklist",
@@ -34,7 +41,157 @@ extension_configs = {
 }
 
 
-def md(text):
-    return Markup(
-        markdown(text, extensions=extensions, extension_configs=extension_configs)
-    )
+def _stable_repr(value: Any) -> str:
+    """repr() that does not depend on object addresses, so it is stable across processes"""
+    if isinstance(value, dict):
+        items = sorted((str(k), _stable_repr(v)) for k, v in value.items())
+        return "{" + ", ".join(f"{k!r}: {v}" for k, v in items) + "}"
+    if isinstance(value, (list, tuple)):
+        return "[" + ", ".join(_stable_repr(v) for v in value) + "]"
+    if callable(value):
+        return (
+            f"{getattr(value, '__module__', '')}.{getattr(value, '__qualname__', '')}"
+        )
+    return repr(value)
+
+
+def config_fingerprint(extensions: List[str], extension_configs: dict) -> str:
+    """
+    Fingerprint of a markdown configuration.
+    Output rendered under one configuration is only reusable under the same fingerprint.
+    """
+    config = _stable_repr([extensions, extension_configs])
+    return hashlib.sha256(config.encode("utf-8")).hexdigest()
+
+
+class ConverterPool:
+    """
+    Pool of reusable Markdown converters sharing one configuration.
+    Building a converter loads every extension, so idle converters are kept
+    and reset between conversions instead of being rebuilt for every chunk.
+    Each converter is handed to one thread at a time.
+    """
+
+    def __init__(self, extensions: List[str], extension_configs: dict):
+        self.extensions = extensions
+        self.extension_configs = extension_configs
+        self.fingerprint = config_fingerprint(extensions, extension_configs)
+        self._idle: List[Markdown] = []
+        self._lock = Lock()
+
+    def _create(self) -> Markdown:
+        return Markdown(
+            extensions=self.extensions, extension_configs=self.extension_configs
+        )
+
+    @contextmanager
+    def converter(self) -> Iterator[Markdown]:
+        """Borrow an idle converter, or build a new one if all are in use"""
+        with self._lock:
+            converter = self._idle.pop() if self._idle else None
+        if converter is None:
+            converter = self._create()
+        try:
+            yield converter
+        finally:
+            converter.reset()
+            with self._lock:
+                self._idle.append(converter)
+
+    def convert(self, text: str) -> str:
+        with self.converter() as converter:
+            return converter.convert(text)
+
+
+converter_pool = ConverterPool(extensions, extension_configs)
+render_cache = RenderCache()
+
+# Below this many uncached chunks, starting worker processes costs more than it saves
+MIN_PARALLEL_CHUNKS = 64
+
+
+def _lookup(key: str, disk_cache: Optional[DiskCache]) -> Optional[str]:
+    html = render_cache.get(key)
+    if html is None and disk_cache:
+        data = disk_cache.get("chunks", key)
+        if data is not None:
+            html = data.decode("utf-8")
+            render_cache.put(key, html)
+    return html
+
+
+def _store(key: str, html: str, disk_cache: Optional[DiskCache]):
+    render_cache.put(key, html)
+    if disk_cache:
+        disk_cache.put("chunks", key, html.encode("utf-8"))
+
+
+def render(
+    text: str,
+    pool: ConverterPool = converter_pool,
+    disk_cache: Optional[DiskCache] = None,
+) -> str:
+    """
+    Convert markdown to html, reusing earlier output for identical text and configuration.
+    Looks in the in-process cache first, then in disk_cache if one is given.
+    """
+    key = content_key(text, pool.fingerprint)
+    html = _lookup(key, disk_cache)
+    if html is None:
+        html = pool.convert(text)
+        _store(key, html, disk_cache)
+    return html
+
+
+def _convert(text: str) -> str:
+    """Worker entry point, converts with the worker's own default pool"""
+    return converter_pool.convert(text)
+
+
+def render_many(
+    texts: List[str],
+    jobs: int = 1,
+    disk_cache: Optional[DiskCache] = None,
+    executor: Optional[Executor] = None,
+) -> Dict[str, str]:
+    """
+    Convert many markdown texts at once, spreading uncached ones over worker processes.
+    Falls back to converting in this process when jobs is 1 or there are too few
+    uncached texts to make workers worthwhile.
+
+    :param texts: Markdown texts, duplicates are converted once
+    :param jobs: Number of worker processes
+    :param disk_cache: Optional on-disk cache consulted and filled alongside the in-process cache
+    :param executor: Optional running executor to use instead of starting new workers
+    :return: Mapping from each text to its html, in the order texts first appear
+    """
+    unique = list(dict.fromkeys(texts))
+    results = {}
+    missing = []
+    for text in unique:
+        html = _lookup(content_key(text, converter_pool.fingerprint), disk_cache)
+        if html is None:
+            missing.append(text)
+        else:
+            results[text] = html
+
+    if jobs > 1 and len(missing) >= MIN_PARALLEL_CHUNKS:
+        chunksize = max(1, len(missing) // (jobs * 4))
+        if executor is not None:
+            converted = list(executor.map(_convert, missing, chunksize=chunksize))
+        else:
+            with ProcessPoolExecutor(max_workers=jobs) as pool_executor:
+                converted = list(
+                    pool_executor.map(_convert, missing, chunksize=chunksize)
+                )
+    else:
+        converted = [converter_pool.convert(text) for text in missing]
+
+    for text, html in zip(missing, converted):
+        _store(content_key(text, converter_pool.fingerprint), html, disk_cache)
+        results[text] = html
+    return {text: results[text] for text in unique}
+
+
+def md(text, disk_cache: Optional[DiskCache] = None):
+    return Markup(render(text, disk_cache=disk_cache))
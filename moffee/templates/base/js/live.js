@@ -0,0 +1,72 @@
+// Live mode: patch changed slides in place instead of reloading the page.
+// moffee pushes patches as livereload reload messages whose path starts with PREFIX.
+(function () {
+    const PREFIX = 'moffee-slides:';
+
+    function parseSlide(html) {
+        const template = document.createElement('template');
+        template.innerHTML = html;
+        return template.content.firstElementChild;
+    }
+
+    function applyPatch(patch) {
+        const current = Array.from(document.querySelectorAll('[data-slide-id]'));
+        if (current.length === 0) {
+            return false;
+        }
+        const byId = new Map(current.map(slide => [slide.dataset.slideId, slide]));
+        const next = [];
+        const patched = [];
+        for (const id of patch.order) {
+            let slide = byId.get(id);
+            if (id in patch.slides) {
+                slide = parseSlide(patch.slides[id]);
+                patched.push(slide);
+            }
+            if (!slide) {
+                return false;
+            }
+            next.push(slide);
+        }
+
+        const sameOrder = next.length === current.length &&
+            patch.order.every((id, i) => id === current[i].dataset.slideId);
+        if (sameOrder) {
+            next.forEach((slide, i) => {
+                if (slide !== current[i]) {
+                    current[i].replaceWith(slide);
+                }
+            });
+        } else {
+            const scroll = window.scrollY;
+            const parent = current[0].parentNode;
+            const anchor = current[current.length - 1].nextSibling;
+            current.forEach(slide => slide.remove());
+            next.forEach(slide => parent.insertBefore(slide, anchor));
+            window.scrollTo(window.scrollX, scroll);
+        }
+        window.slidesPatched(patched);
+        return true;
+    }
+
+    class LiveReloadPluginMoffee {
+        static identifier = 'moffee';
+        static version = '1.0';
+
+        reload(path) {
+            if (!path.startsWith(PREFIX)) {
+                return false;
+            }
+            if (!applyPatch(JSON.parse(path.slice(PREFIX.length)))) {
+                window.location.reload();
+            }
+            return true;
+        }
+    }
+
+    // Picked up by livereload.js when it loads, or added right away if it already has
+    window.LiveReloadPluginMoffee = LiveReloadPluginMoffee;
+    if (window.LiveReload) {
+        window.LiveReload.addPlugin(LiveReloadPluginMoffee);
+    }
+})();
@@ -1,7 +1,7 @@
 // Automatic resizing to fit elements
 window.addEventListener('load', function () {
-    function autoScale() {
-        const elements = document.querySelectorAll('.auto-sizing');
+    function autoScale(root = document) {
+        const elements = root.querySelectorAll('.auto-sizing');
 
         elements.forEach(element => {
             const container = element.parentElement;
@@ -68,7 +68,7 @@ window.addEventListener('load', function () {
     // update
     // window.addEventListener('resize', autoScale);
     document.querySelectorAll('img').forEach(img => {
-        img.addEventListener('load', autoScale);
+        img.addEventListener('load', () => autoScale());
     });
     // setInterval(autoScale, 1000);
     window.triggerAutoScale = autoScale;
@@ -78,7 +78,7 @@ window.addEventListener('load', function () {
 // Presentation mode
 let isPresentationMode = false;
 let currentSlide = 0;
-const slides = document.querySelectorAll('.slide-container');
+let slides = document.querySelectorAll('.slide-container');
 
 function togglePresentationMode() {
     isPresentationMode = !isPresentationMode;
@@ -165,3 +165,24 @@ function fullscreenCheck() {
 }
 
 window.addEventListener('resize', fullscreenCheck);
+
+// Re-run math, diagrams and scaling on slides patched in by live mode
+window.slidesPatched = function (patched) {
+    slides = document.querySelectorAll('.slide-container');
+    patched.forEach(slide => {
+        if (window.renderMathInElement) {
+            renderMathInElement(slide);
+        }
+        if (window.mermaid) {
+            window.mermaid.run({ nodes: slide.querySelectorAll('.mermaid') });
+        }
+        window.triggerAutoScale(slide);
+        slide.querySelectorAll('img').forEach(img => {
+            img.addEventListener('load', () => window.triggerAutoScale(slide));
+        });
+    });
+    fullscreenCheck();
+    if (isPresentationMode) {
+        showSlide(Math.min(currentSlide, slides.length - 1));
+    }
+};
@@ -0,0 +1,253 @@
+import hashlib
+import os
+import re
+import tempfile
+from collections import OrderedDict
+from threading import Lock
+from typing import List, Optional, Tuple
+
+from moffee import __version__
+
+DEFAULT_MAX_ENTRIES = 4096
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_DISK_MAX_BYTES = 512 * 1024 * 1024
+
+# Subdirectories of a DiskCache root holding its entries. templates holds
+# compiled templates, see builder.template_bytecode_cache
+NAMESPACES = ("chunks", "pages", "templates")
+# Names of files the cache writes, nothing else is ever deleted
+ENTRY_PATTERN = re.compile(r"[0-9a-f]{64}|\.tmp-.*|__jinja2_.*\.cache")
+
+
+def content_key(text: str, fingerprint: str = "") -> str:
+    """
+    Build a cache key from some content and the fingerprint of whatever produced it.
+
+    :param text: Content to be hashed, e.g. a chunk of markdown
+    :param fingerprint: Identifies the configuration the content is processed with
+    :return: Hex digest usable as a cache key
+    """
+    digest = hashlib.sha256(fingerprint.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(text.encode("utf-8"))
+    return digest.hexdigest()
+
+
+class RenderCache:
+    """
+    In-process LRU cache of rendered strings.
+    Entries are evicted least recently used first once either the entry cap
+    or the byte cap is exceeded. Safe to share between threads.
+    """
+
+    def __init__(
+        self, max_entries: int = DEFAULT_MAX_ENTRIES, max_bytes: int = DEFAULT_MAX_BYTES
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        self._entries: "OrderedDict[str, Tuple[str, int]]" = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: str, value: str):
+        nbytes = len(value.encode("utf-8"))
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+            if nbytes > self.max_bytes:
+                return
+            self._entries[key] = (value, nbytes)
+            self.size += nbytes
+            self._evict()
+
+    def resize(
+        self, max_entries: Optional[int] = None, max_bytes: Optional[int] = None
+    ):
+        """Change the caps, evicting entries right away if they are now exceeded"""
+        with self._lock:
+            if max_entries is not None:
+                self.max_entries = max_entries
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+            _, (_, evicted_bytes) = self._entries.popitem(last=False)
+            self.size -= evicted_bytes
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+def default_cache_dir() -> str:
+    """Cache location, from $MOFFEE_CACHE_DIR or the user cache directory"""
+    if os.environ.get("MOFFEE_CACHE_DIR"):
+        return os.environ["MOFFEE_CACHE_DIR"]
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(base, "moffee")
+
+
+class DiskCache:
+    """
+    Persistent cache of byte blobs shared across processes.
+    Entries live in one file each under root/namespace/. Keys are combined with the
+    moffee version, so upgrading never reads stale entries. Writes go to a temporary
+    file that is atomically renamed into place, so concurrent builds sharing the
+    directory never observe partial entries. Once the total size exceeds max_bytes,
+    the least recently used entries are deleted.
+
+    Only files the cache writes under root/<namespace>/ are ever read, counted or
+    deleted, so root may contain other files. Cached pages are pickled, so root must
+    only be writable by users trusted with running code as the user building.
+    """
+
+    EVICT_RATIO = 0.8
+
+    def __init__(
+        self,
+        root: str,
+        max_bytes: int = DEFAULT_DISK_MAX_BYTES,
+        version: str = __version__,
+    ):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self._size: Optional[int] = None
+        self._lock = Lock()
+
+    def _path(self, namespace: str, key: str) -> str:
+        if namespace not in NAMESPACES:
+            raise ValueError(f"Unknown cache namespace: {namespace}")
+        name = content_key(key, self.version)
+        return os.path.join(self.root, namespace, name[:2], name)
+
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        path = self._path(namespace, key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            self.misses += 1
+            return None
+        try:
+            # Refresh mtime, which eviction uses as the last access time
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return data
+
+    def put(self, namespace: str, key: str, data: bytes):
+        path = self._path(namespace, key)
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError:
+            # A cache that cannot be written must never fail the build
+            return
+
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan_size()
+            else:
+                self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _entries(self) -> List[Tuple[float, int, str]]:
+        """(mtime, size, path) of every entry"""
+        entries = []
+        for namespace in NAMESPACES:
+            for dirpath, _, filenames in os.walk(os.path.join(self.root, namespace)):
+                for name in filenames:
+                    if not ENTRY_PATTERN.fullmatch(name):
+                        continue
+                    path = os.path.join(dirpath, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _scan_size(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        size = sum(size for _, size, _ in entries)
+        target = self.max_bytes * self.EVICT_RATIO
+        for _, entry_size, path in entries:
+            if size <= target:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                # Another process got to it first
+                pass
+            size -= entry_size
+        self._size = size
+
+    def clear(self):
+        """Delete every entry"""
+        for _, _, path in self._entries():
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        with self._lock:
+            self._size = 0
+
+    def stats(self) -> dict:
+        entries = self._entries()
+        return {
+            "path": self.root,
+            "entries": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+            "max_bytes": self.max_bytes,
+        }
@@ -1,25 +1,323 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import errno
+import hashlib
+import html
 import os
 import re
 import shutil
+import stat
+import sys
+from threading import Lock
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 from urllib.parse import unquote, urlparse, quote
 from pathlib import Path
 import uuid
 
-from bs4 import BeautifulSoup
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 
-def merge_directories(base_dir: str, output_dir: str, merge_dir: str = None):
-    """Merge base_dir and merge_dir into output_dir, merge_dir overwrites base_dir if confliction happens"""
-    # Clear the output_dir before writing the merged files
-    if os.path.exists(output_dir):
-        shutil.rmtree(output_dir)
+def merge_directories(
+    base_dir: str,
+    output_dir: str,
+    merge_dir: str = None,
+    keep: Iterable[str] = (),
+    exclude: Iterable[str] = (),
+):
+    """
+    Merge base_dir and merge_dir into output_dir, merge_dir overwrites base_dir if confliction happens.
+    output_dir is synced incrementally: only files whose size or mtime differ from their source
+    are copied, and whatever is in neither directory is removed.
+
+    :param base_dir: Base directory
+    :param output_dir: Output directory, created if missing
+    :param merge_dir: Optional directory merged over base_dir
+    :param keep: Names of entries directly under output_dir to leave alone, e.g. generated assets
+    :param exclude: Names of entries directly under base_dir and merge_dir not to copy
+    """
+    # Relative path -> source file, merge_dir last so it wins
+    sources = {}
+    for source_dir in [base_dir, merge_dir]:
+        if not source_dir:
+            continue
+        for dirpath, dirnames, filenames in os.walk(source_dir):
+            if dirpath == source_dir:
+                dirnames[:] = [name for name in dirnames if name not in exclude]
+                filenames = [name for name in filenames if name not in exclude]
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                sources[os.path.relpath(path, source_dir)] = path
+    source_dirs = set()
+    for relpath in sources:
+        relpath = os.path.dirname(relpath)
+        while relpath and relpath not in source_dirs:
+            source_dirs.add(relpath)
+            relpath = os.path.dirname(relpath)
+
     Path(output_dir).mkdir(parents=True, exist_ok=True)
 
-    shutil.copytree(base_dir, output_dir, dirs_exist_ok=True)
-    if merge_dir:
-        shutil.copytree(
-            merge_dir, output_dir, dirs_exist_ok=True, copy_function=shutil.copy2
+    # Remove stale files
+    for dirpath, dirnames, filenames in os.walk(output_dir):
+        if dirpath == output_dir:
+            dirnames[:] = [name for name in dirnames if name not in keep]
+            filenames = [name for name in filenames if name not in keep]
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if os.path.relpath(path, output_dir) not in sources:
+                os.unlink(path)
+        for name in list(dirnames):
+            path = os.path.join(dirpath, name)
+            if os.path.relpath(path, output_dir) not in source_dirs:
+                _remove(path)
+                dirnames.remove(name)
+
+    # Copy new and changed files
+    for relpath, source in sources.items():
+        target = os.path.join(output_dir, relpath)
+        try:
+            source_stat = os.stat(source)
+            target_stat = os.lstat(target)
+        except FileNotFoundError:
+            pass
+        else:
+            if (
+                stat.S_ISREG(target_stat.st_mode)
+                and target_stat.st_size == source_stat.st_size
+                and target_stat.st_mtime_ns == source_stat.st_mtime_ns
+            ):
+                continue
+            _remove(target)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copy2(source, target)
+
+
+def _remove(path: str):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+
+# Tags and attributes to check for URLs
+URL_ATTRIBUTES = {"img": "src", "link": "href", "script": "src", "a": "href"}
+
+TAG_PATTERN = re.compile(
+    r"<(?P<tag>img|link|script|a)(?=[\s/>])(?P<attrs>(?:\"[^\"]*\"|'[^']*'|[^'\">])*)>",
+    re.IGNORECASE,
+)
+# Start of a tag TAG_PATTERN may still match once more text follows, or of its name
+TAG_START_PATTERN = re.compile(
+    r"<(?:(?:img|link|script|a)(?=[\s/>]|\Z)|[a-z]{0,5}\Z)", re.IGNORECASE
+)
+ATTRIBUTE_PATTERN = re.compile(
+    r"(?P<name>[^\s/>=]+)(?:\s*=\s*(?P<value>\"[^\"]*\"|'[^']*'|[^\s>]+))?"
+)
+
+
+def rewrite_urls(document: str, rewrite: Callable[[str], str]) -> str:
+    """
+    Rewrite the URL attributes of img, link, script and a tags.
+    Works on any fragment of html that does not cut through a tag, so documents
+    can be processed piece by piece.
+
+    :param document: HTML document or fragment
+    :param rewrite: Function from an unescaped attribute value to its new value
+    :return: Document with the URL attributes replaced, everything else untouched
+    """
+
+    def rewrite_attribute(match: re.Match, attr: str) -> str:
+        value = match.group("value")
+        if match.group("name").lower() != attr or value is None:
+            return match.group(0)
+        if value[0] in "\"'":
+            value = value[1:-1]
+        value = html.unescape(value)
+        new_value = rewrite(value)
+        if new_value == value:
+            return match.group(0)
+        return f'{match.group("name")}="{html.escape(new_value)}"'
+
+    def rewrite_tag(match: re.Match) -> str:
+        attr = URL_ATTRIBUTES[match.group("tag").lower()]
+        attrs = ATTRIBUTE_PATTERN.sub(
+            lambda m: rewrite_attribute(m, attr), match.group("attrs")
         )
+        return f"<{match.group('tag')}{attrs}>"
+
+    return TAG_PATTERN.sub(rewrite_tag, document)
+
+
+def _complete_end(text: str) -> int:
+    """
+    End of the longest prefix of text that rewrite_urls handles the same way as
+    the whole document: up to the first URL tag that does not match yet.
+    Tags are matched from left to right like rewrite_urls does, so tags inside
+    the quoted attribute values of another tag are skipped.
+    """
+    pos = 0
+    while start := TAG_START_PATTERN.search(text, pos):
+        match = TAG_PATTERN.match(text, start.start())
+        if match is None:
+            return start.start()
+        pos = match.end()
+    return len(text)
+
+
+def rewrite_url_stream(
+    pieces: Iterable[str],
+    rewrite: Callable[[str], str],
+    buffer_size: int = 64 * 1024,
+) -> Iterator[str]:
+    """
+    Streaming version of rewrite_urls.
+    Pieces may cut through tags, they are buffered up to about buffer_size characters
+    and rewritten up to the first URL tag that is not complete yet. Quoted attribute
+    values may hold < and >, so a malformed tag keeps everything after it buffered.
+
+    :param pieces: Consecutive pieces of an HTML document, e.g. from Template.generate
+    :param rewrite: Function from an unescaped attribute value to its new value
+    :param buffer_size: Characters to collect before rewriting
+    :return: Iterator of rewritten pieces
+    """
+    buffer: List[str] = []
+    size = 0
+    for piece in pieces:
+        buffer.append(piece)
+        size += len(piece)
+        if size < buffer_size:
+            continue
+        text = "".join(buffer)
+        cut = _complete_end(text)
+        yield rewrite_urls(text[:cut], rewrite)
+        buffer = [text[cut:]]
+        size = len(buffer[0])
+    yield rewrite_urls("".join(buffer), rewrite)
+
+
+def resolve_base_paths(document_path: str, resource_dir: str = ".") -> List[str]:
+    """
+    Absolute base paths relative URLs of a document are tried against, in order, see redirect_paths.
+    """
+    return [
+        os.path.abspath(base)
+        for base in [
+            os.path.dirname(document_path),
+            os.path.abspath(resource_dir),
+            os.path.join(os.path.dirname(document_path), resource_dir),
+        ]
+    ]
+
+
+def resolve_url(
+    url: str, base_paths: List[str], exists: Callable[[str], bool] = os.path.exists
+) -> str:
+    """
+    Redirect a relative path to an absolute path under the first base path it exists in.
+    Returns url itself if it is already absolute or no base path leads to an existing file.
+
+    :param url: Decoded url
+    :param base_paths: Absolute base paths to try, in order
+    :param exists: Function checking whether a path exists, e.g. PathIndex.exists
+    :return: Redirected url
+    """
+
+    def is_absolute_url(url):
+        return bool(urlparse(url).netloc) or (os.path.isabs(url) and exists(url))
+
+    if is_absolute_url(url):
+        return url
+
+    for base in base_paths:
+        absolute_url = os.path.abspath(os.path.normpath(os.path.join(base, url)))
+        if exists(absolute_url):
+            return absolute_url
+
+    return url
+
+
+class PathIndex:
+    """
+    In-memory index of directory listings, answering which paths exist without a stat call each.
+    Each directory is listed once, on its first lookup. refresh() drops the listings of
+    directories whose mtime changed since, so an index can be kept across builds.
+    Resolved urls are memoized until a listing is dropped.
+    """
+
+    def __init__(self):
+        # Directory -> (mtime, names of its entries), mtime is None if it could not be listed
+        self._listings: Dict[str, Tuple[Optional[int], Set[str]]] = {}
+        self._folded: Dict[str, Set[str]] = {}
+        self._resolved: Dict[Tuple[str, Tuple[str, ...]], str] = {}
+        self._lock = Lock()
+
+    def _listing(self, directory: str) -> Set[str]:
+        listing = self._listings.get(directory)
+        if listing is not None:
+            return listing[1]
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+            names = set()
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    # Broken symlinks do not exist for os.path.exists
+                    if entry.is_symlink() and not os.path.exists(entry.path):
+                        continue
+                    names.add(entry.name)
+        except OSError:
+            mtime, names = None, set()
+        with self._lock:
+            self._listings[directory] = (mtime, names)
+            self._folded[directory] = {name.casefold() for name in names}
+        return names
+
+    def exists(self, path: str) -> bool:
+        """Same as os.path.exists for absolute paths"""
+        directory, name = os.path.split(os.path.normpath(path))
+        if not name:
+            return os.path.exists(path)
+        if name in self._listing(directory):
+            return True
+        # Case-insensitive file systems find names in a different case
+        if name.casefold() in self._folded.get(directory, ()):
+            return os.path.exists(path)
+        return False
+
+    def resolve(self, url: str, base_paths: List[str]) -> str:
+        """Memoized resolve_url"""
+        key = (url, tuple(base_paths))
+        resolved = self._resolved.get(key)
+        if resolved is None:
+            resolved = resolve_url(url, base_paths, self.exists)
+            self._resolved[key] = resolved
+        return resolved
+
+    def refresh(self):
+        """Drop the listings of directories changed since they were listed"""
+        with self._lock:
+            changed = []
+            for directory, (mtime, _) in self._listings.items():
+                try:
+                    current = os.stat(directory).st_mtime_ns
+                except OSError:
+                    current = None
+                if current != mtime:
+                    changed.append(directory)
+            for directory in changed:
+                del self._listings[directory]
+                del self._folded[directory]
+            if changed:
+                self._resolved.clear()
+
+    def clear(self):
+        with self._lock:
+            self._listings.clear()
+            self._folded.clear()
+            self._resolved.clear()
+
+
+path_index = PathIndex()
 
 
 def redirect_paths(document: str, document_path: str, resource_dir: str = ".") -> str:
@@ -36,112 +334,252 @@ def redirect_paths(document: str, document_path: str, resource_dir: str = ".") -
     :param resource_dir: Optional resource path
     :return: Document string with all urls redirected.
     """
+    base_paths = resolve_base_paths(document_path, resource_dir)
+    path_index.refresh()
+    return rewrite_urls(
+        document, lambda url: path_index.resolve(unquote(url), base_paths)
+    )
 
-    def is_absolute_url(url):
-        return bool(urlparse(url).netloc) or (
-            os.path.isabs(url) and os.path.exists(url)
-        )
 
-    def make_absolute(base, relative):
-        return os.path.abspath(os.path.normpath(os.path.join(base, relative)))
+# Digests of files by path, with the size and mtime they were computed for
+_digests: Dict[str, Tuple[int, int, str]] = {}
 
-    def redirect_url(url):
-        if is_absolute_url(url):
-            return url
 
-        # Try different base paths to make the URL absolute
-        base_paths = [
-            os.path.dirname(document_path),
-            os.path.abspath(resource_dir),
-            os.path.join(os.path.dirname(document_path), resource_dir),
-        ]
+def file_digest(path: str) -> str:
+    """
+    Hex sha256 of a file's content.
+    Remembered per path until the file's size or mtime changes.
+    """
+    file_stat = os.stat(path)
+    cached = _digests.get(path)
+    if cached is not None and cached[:2] == (file_stat.st_size, file_stat.st_mtime_ns):
+        return cached[2]
 
-        for base in base_paths:
-            absolute_url = make_absolute(base, url)
-            if os.path.exists(absolute_url) or is_absolute_url(absolute_url):
-                return absolute_url
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    _digests[path] = (file_stat.st_size, file_stat.st_mtime_ns, digest.hexdigest())
+    return digest.hexdigest()
 
-        return url
 
-    soup = BeautifulSoup(document, "html.parser")
+# Linux ioctl cloning a file's extents, see ioctl_ficlone(2)
+FICLONE = 0x40049409
 
-    # Tags and attributes to check for URLs
-    tag_attr_pairs = [
-        ("img", "src"),
-        ("link", "href"),
-        ("script", "src"),
-        ("a", "href"),
-    ]
+DEFAULT_COPY_WORKERS = 8
 
-    for tag, attr in tag_attr_pairs:
-        for element in soup.find_all(tag):
-            if element.has_attr(attr):
-                original_url = element[attr]
-                decoded_url = unquote(original_url)
-                redirected_url = redirect_url(decoded_url)
-                element[attr] = redirected_url
+ASSET_MODES = ["copy", "hardlink", "reflink", "symlink", "auto"]
+# Modes tried by "auto", cheapest first
+AUTO_MODES = ["symlink", "hardlink", "reflink", "copy"]
+# Modes giving files independent of their source
+INDEPENDENT_MODES = ["copy", "reflink"]
 
-    return str(soup)
 
+def _reflink(source: str, target: str):
+    if fcntl is None or not sys.platform.startswith("linux"):
+        raise OSError(errno.EOPNOTSUPP, "Reflinks are not supported on this platform")
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    shutil.copystat(source, target)
 
-def copy_assets(document: str, target_dir: str) -> str:
-    """
-    Copy all asset resources in an HTML document to target_dir, then update URLs to target_dir/uuid_originalname.ext
-    Handles encoded URLs.
 
-    :param document: HTML document to process
-    :param target_dir: Target directory
-    :return: Updated document with URLs redirected
+_materializers = {
+    "copy": shutil.copy2,
+    "hardlink": os.link,
+    "reflink": _reflink,
+    "symlink": lambda source, target: os.symlink(os.path.abspath(source), target),
+}
+
+
+def materialize(source: str, target: str, mode: str = "copy") -> str:
     """
-    if not os.path.exists(target_dir):
-        os.makedirs(target_dir)
+    Make the file source available at target, which must not exist.
+    Modes that do not work for the two paths fall back to copying.
 
-    soup = BeautifulSoup(document, "html.parser")
+    :param source: Existing file
+    :param target: Path to create
+    :param mode: One of "copy", "hardlink", "reflink", "symlink", or "auto" for the cheapest that works
+    :return: Mode actually used
+    """
+    if mode not in ASSET_MODES:
+        raise ValueError(f"Unknown asset mode: {mode}")
+    candidates = AUTO_MODES if mode == "auto" else [mode, "copy"]
+    for candidate in candidates:
+        try:
+            _materializers[candidate](source, target)
+            return candidate
+        except OSError:
+            if candidate == "copy":
+                raise
+            if os.path.lexists(target):
+                os.unlink(target)
+
+
+def asset_source(url: str) -> Optional[str]:
+    """
+    File an url points to. Handles encoded URLs.
 
-    # Dictionary to store original path to new path mapping
-    path_mapping = {}
+    :param url: Attribute value, possibly encoded
+    :return: Absolute path of the file, None if url is external or not a file
+    """
+    # Decode the URL
+    decoded_path = unquote(url)
 
-    # Tags and attributes to check for URLs
-    tag_attr_pairs = [
-        ("img", "src"),
-        ("link", "href"),
-        ("script", "src"),
-        ("a", "href"),
-    ]
+    # Skip if it's an external URL
+    if urlparse(decoded_path).scheme:
+        return None
+    # Convert to absolute path if it's relative
+    absolute_path = os.path.abspath(decoded_path)
+    # Skip if it's not a file
+    if not os.path.isfile(absolute_path):
+        return None
+    return absolute_path
 
-    for tag, attr in tag_attr_pairs:
-        for element in soup.find_all(tag):
-            if element.has_attr(attr):
-                original_path = element[attr]
 
-                # Decode the URL
-                decoded_path = unquote(original_path)
+def asset_name(source: str) -> str:
+    """Name of a file among the assets, hash.ext after its content"""
+    _, ext = os.path.splitext(source)
+    return f"{file_digest(source)[:16]}{ext}"
 
-                # Skip if it's an external URL
-                if urlparse(decoded_path).scheme:
-                    continue
 
-                # Convert to absolute path if it's relative
-                absolute_path = os.path.abspath(decoded_path)
+class AssetStore:
+    """
+    Copies the files a document refers to into target_dir, named after their content: hash.ext.
+    Files are collected with add() first, then copied at once by copy_all() over a pool of
+    threads. Identical files are stored once, and files already in target_dir are not copied again.
+    """
 
-                # Skip if it's not a file
-                if not os.path.isfile(absolute_path):
-                    continue
+    def __init__(
+        self,
+        target_dir: str,
+        mode: str = "copy",
+        max_workers: int = DEFAULT_COPY_WORKERS,
+    ):
+        """
+        :param target_dir: Target directory, must exist
+        :param mode: How files are copied, see materialize
+        :param max_workers: Number of files copied at the same time
+        """
+        self.target_dir = target_dir
+        self.mode = mode
+        self.max_workers = max_workers
+        # Source file of each url added, None if it is not an asset
+        self._sources: Dict[str, Optional[str]] = {}
+        self.copied: Dict[str, str] = {}
+        self.failed: Dict[str, OSError] = {}
+        self._name_locks: Dict[str, Lock] = {}
+        self._lock = Lock()
+
+    def add(self, url: str) -> Optional[str]:
+        """
+        Collect the file an url points to. Handles encoded URLs.
+
+        :param url: Attribute value, possibly encoded
+        :return: Absolute path of the file, None if url is external or not a file
+        """
+        if url in self._sources:
+            return self._sources[url]
+        source = asset_source(url)
+        self._sources[url] = source
+        return source
+
+    def copy_all(self, progress: Optional[Callable[[int, int], None]] = None):
+        """
+        Copy every file collected and not copied yet.
+        Files that cannot be copied are recorded in failed instead of raising.
+
+        :param progress: Called with the number of files done and the total after each file
+        """
+        sources = {
+            source
+            for source in self._sources.values()
+            if source is not None
+            and source not in self.copied
+            and source not in self.failed
+        }
+        if not sources:
+            return
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                executor.submit(self._copy, source): source for source in sources
+            }
+            for done, future in enumerate(as_completed(futures), start=1):
+                source = futures[future]
+                try:
+                    self.copied[source] = future.result()
+                except OSError as e:
+                    self.failed[source] = e
+                if progress:
+                    progress(done, len(futures))
+
+    def _copy(self, source: str) -> str:
+        new_path = os.path.join(self.target_dir, asset_name(source))
+        with self._lock:
+            name_lock = self._name_locks.setdefault(new_path, Lock())
+
+        # Identical files share a name, only the first one is copied
+        with name_lock:
+            if self._reusable(new_path):
+                return new_path
+            # Through a temporary file so an interrupted copy is never reused
+            tmp_path = os.path.join(self.target_dir, f".tmp-{uuid.uuid4().hex}")
+            try:
+                materialize(source, tmp_path, self.mode)
+                os.replace(tmp_path, new_path)
+            except BaseException:
+                if os.path.lexists(tmp_path):
+                    os.unlink(tmp_path)
+                raise
+        return new_path
+
+    def _reusable(self, path: str) -> bool:
+        """Whether a file left at path, e.g. by an earlier build, can be kept"""
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return False
+        if self.mode not in INDEPENDENT_MODES:
+            return os.path.exists(path)
+        # Links from a build in another mode would follow edits of their source
+        return stat.S_ISREG(st.st_mode) and st.st_nlink == 1
+
+    def prune(self):
+        """Remove files in target_dir that were not copied by this store, e.g. assets of earlier builds"""
+        copied = {os.path.basename(path) for path in self.copied.values()}
+        for name in os.listdir(self.target_dir):
+            if name not in copied:
+                _remove(os.path.join(self.target_dir, name))
+
+    def new_path(self, url: str) -> Optional[str]:
+        """Path the file of an added url was copied to, None if it was not copied"""
+        source = self._sources.get(url)
+        return self.copied.get(source) if source is not None else None
+
+
+def copy_assets(document: str, target_dir: str, mode: str = "copy") -> str:
+    """
+    Copy all asset resources in an HTML document to target_dir, then update URLs to target_dir/hash.ext
+    Handles encoded URLs.
 
-                if original_path not in path_mapping:
-                    # Generate a new filename
-                    original_filename = os.path.basename(absolute_path)
-                    name, ext = os.path.splitext(original_filename)
-                    new_filename = f"{str(uuid.uuid4())[:8]}_{name}{ext}"
-                    new_path = os.path.join(target_dir, new_filename)
+    :param document: HTML document to process
+    :param target_dir: Target directory
+    :param mode: How files are copied, see materialize
+    :return: Updated document with URLs redirected
+    """
+    if not os.path.exists(target_dir):
+        os.makedirs(target_dir)
 
-                    # Copy the file
-                    shutil.copy2(absolute_path, new_path)
+    store = AssetStore(target_dir, mode)
 
-                    # Store the mapping
-                    path_mapping[original_path] = new_path
+    # Collect every asset first, then copy them all before rewriting any url
+    def collect(url):
+        store.add(url)
+        return url
 
-                # Update the attribute with the new path
-                element[attr] = quote(path_mapping[original_path])
+    def rewrite(url):
+        new_path = store.new_path(url)
+        return quote(new_path) if new_path else url
 
-    return str(soup)
+    rewrite_urls(document, collect)
+    store.copy_all()
+    return rewrite_urls(document, rewrite)
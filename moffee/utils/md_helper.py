@@ -1,7 +1,7 @@
 import os
 from urllib.parse import urljoin, urlparse
 import re
-from typing import Optional
+from typing import Iterable, Iterator, List, Optional
 
 
 def is_comment(line: str) -> bool:
@@ -113,3 +113,61 @@ def rm_comments(document):
     document = re.sub(r"^\s*%%.*$", "", document, flags=re.MULTILINE)
 
     return document.strip()
+
+
+def iter_rm_comments(lines: Iterable[str]) -> Iterator[str]:
+    """
+    Streaming version of rm_comments, without the final strip.
+    Yields the lines "\n".join(lines) would have after removing comments,
+    buffering no more than the lines of a single html comment.
+
+    :param lines: Lines of markdown, without line breaks
+    :return: Iterator of lines with comments removed
+    """
+    # Same as the "%%" substitution, which also swallows whitespace-only lines before the comment
+    blanks: List[str] = []
+    for line in _iter_rm_html_comments(lines):
+        if not line.strip():
+            blanks.append(line)
+        elif line.lstrip().startswith("%%"):
+            blanks.clear()
+            yield ""
+        else:
+            yield from blanks
+            blanks.clear()
+            yield line
+    yield from blanks
+
+
+def _iter_rm_html_comments(lines: Iterable[str]) -> Iterator[str]:
+    """Remove <!-- --> comments, which may span lines, joining the text around them"""
+    head = ""  # Processed text of the current line before an open comment
+    opened: List[str] = []  # Lines from an open comment on, while looking for its end
+    for line in lines:
+        if opened:
+            end = line.find("-->")
+            if end < 0:
+                opened.append(line)
+                continue
+            opened.clear()
+            line = line[end + 3 :]
+        else:
+            head = ""
+
+        while True:
+            start = line.find("<!--")
+            if start < 0:
+                yield head + line
+                break
+            end = line.find("-->", start + 4)
+            if end < 0:
+                head += line[:start]
+                opened.append(line[start:])
+                break
+            head += line[:start]
+            line = line[end + 3 :]
+
+    # An unclosed comment is left as is
+    if opened:
+        opened[0] = head + opened[0]
+        yield from opened
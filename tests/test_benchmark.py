@@ -0,0 +1,36 @@
+import time
+
+import pytest
+
+from moffee.compositor import composite
+
+
+def long_slide(n_lines):
+    """A single slide of pasted log lines, with a few in-slide dividers"""
+    lines = ["# Log dump"]
+    for i in range(n_lines):
+        lines.append(f"2024-01-01 12:00:00 INFO request {i} served in 12ms")
+        if i % 10000 == 0:
+            lines.append("<->")
+    return "\n".join(lines)
+
+
+def time_composite(document, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        pages = composite(document)
+        _ = pages[0].chunk
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def test_single_long_slide_scales_linearly():
+    small = time_composite(long_slide(25_000))
+    large = time_composite(long_slide(100_000))
+    # 4x the lines, allow generous noise. Quadratic building would be ~16x.
+    assert large / small < 8, f"25k lines: {small:.3f}s, 100k lines: {large:.3f}s"
+
+
+if __name__ == "__main__":
+    pytest.main()
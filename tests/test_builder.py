@@ -2,8 +2,17 @@ import os
 import tempfile
 import pytest
 import re
-from moffee.builder import build, render_jinja2, read_options, retrieve_structure
+from moffee import builder
+from moffee.builder import (
+    Document,
+    build,
+    render_jinja2,
+    read_options,
+    retrieve_structure,
+    template_environment,
+)
 from moffee.compositor import composite
+from moffee.markdown import render_cache
 
 
 def template_dir(name="base"):
@@ -46,7 +55,7 @@ Paragraph 3
             f.write("fake image content")
 
         with open(os.path.join(res_dir, "image2.png"), "w") as f:
-            f.write("fake image content")
+            f.write("another fake image content")
 
         yield temp_dir, doc_path, res_dir, output_dir
 
@@ -66,6 +75,45 @@ def test_rendering(setup_test_env):
     assert appeared(html, "chunk-vertical") == 1
 
 
+def test_rendering_with_theme(setup_test_env):
+    _, doc_path, _, _ = setup_test_env
+    with open(doc_path, encoding="utf8") as f:
+        doc = f.read()
+    base = render_jinja2(doc, template_dir())
+    themed = render_jinja2(doc, template_dir(), theme_dir=template_dir("beam"))
+    # beam overrides the content layout only
+    assert base != themed
+    assert appeared(themed, "chunk-paragraph") == 5
+
+
+def test_template_environment_is_shared(tmp_path):
+    base, theme = template_dir(), template_dir("beam")
+    env = template_environment(base, theme)
+    assert template_environment(base, theme) is env
+    assert template_environment(base) is not env
+
+    # Compiled templates are written to the bytecode cache and used by new environments
+    cache_dir = str(tmp_path / "cache")
+    template_environment(base, theme, cache_dir).get_template("index.html")
+    cached = os.listdir(os.path.join(cache_dir, "templates"))
+    assert cached
+    template_environment.cache_clear()
+    template_environment(base, theme, cache_dir).get_template("index.html")
+    assert os.listdir(os.path.join(cache_dir, "templates")) == cached
+
+
+def test_template_changes_are_reloaded(tmp_path):
+    base = tmp_path / "base"
+    base.mkdir()
+    index = base / "index.html"
+    index.write_text("{{ title }} v1")
+    assert render_jinja2("# Hi", str(base)) == "Hi v1"
+    index.write_text("{{ title }} v2")
+    stat = index.stat()
+    os.utime(index, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert render_jinja2("# Hi", str(base)) == "Hi v2"
+
+
 def test_read_options(setup_test_env):
     _, doc_path, _, _ = setup_test_env
     # import ipdb; ipdb.set_trace(context=15)
@@ -77,6 +125,32 @@ def test_read_options(setup_test_env):
     assert options.resource_dir == "resources"
 
 
+def test_document(setup_test_env):
+    _, doc_path, _, _ = setup_test_env
+    document = Document.load(doc_path)
+    assert document.path == doc_path
+    assert document.title == "Test page"
+    assert document.options.theme == "beam"
+    assert len(document.pages) == 2
+    assert document.structure["headings"][0]["content"] == "Test page"
+    assert document.content.startswith("# Test page")
+
+
+def test_document_title_fallback():
+    assert Document.parse("No headings here").title == "Untitled"
+    assert Document.parse("### Small\nText\n## Sub\nMore").title == "Sub"
+
+
+def test_document_update():
+    source = "# Title\nText\n---\nMore\n## Sub\nEnd"
+    document = Document.parse(source)
+    updated = document.update(source.replace("More", "# New title\nMore"))
+    expected = Document.parse(updated.source)
+    assert updated.pages == expected.pages
+    assert updated.structure == expected.structure
+    assert document.update("---\ntheme: beam\n---\n" + source).options.theme == "beam"
+
+
 def test_build(setup_test_env):
     temp_dir, doc_path, res_dir, output_dir = setup_test_env
     options = read_options(doc_path)
@@ -89,6 +163,8 @@ def test_build(setup_test_env):
     assert os.path.exists(j(output_dir, "css"))
     assert os.path.exists(j(output_dir, "js"))
     assert os.path.exists(j(output_dir, "assets"))
+    # Templates are rendered in place, not copied
+    assert not os.path.exists(j(output_dir, "layouts"))
     asset_dir = os.listdir(j(output_dir, "assets"))
     assert len(asset_dir) == 2
     for name in asset_dir:
@@ -99,6 +175,79 @@ def test_build(setup_test_env):
         assert len(f.readlines()) > 2
 
 
+def test_build_with_disk_cache(setup_test_env):
+    temp_dir, doc_path, res_dir, _ = setup_test_env
+    options = read_options(doc_path)
+    cache_dir = os.path.join(temp_dir, "cache")
+    render_cache.clear()
+    outputs = []
+    for name in ["cached-1", "cached-2"]:
+        output_dir = os.path.join(temp_dir, name)
+        build(
+            doc_path,
+            output_dir,
+            template_dir(),
+            template_dir(options.theme),
+            cache_dir=cache_dir,
+        )
+        with open(os.path.join(output_dir, "index.html"), encoding="utf8") as f:
+            outputs.append(f.read())
+
+    assert outputs[0] == outputs[1]
+    assert os.listdir(os.path.join(cache_dir, "chunks"))
+    assert os.listdir(os.path.join(cache_dir, "pages"))
+
+
+def test_page_cache_with_dates_in_front_matter(tmp_path, monkeypatch):
+    doc_path = tmp_path / "doc.md"
+    doc_path.write_text(
+        "---\ndate: 2024-05-01\nupdated: 2024-05-01 10:00:00+02:00\n---\n# Title\nText"
+    )
+    calls = []
+    paginate = builder.paginate
+    monkeypatch.setattr(
+        builder, "paginate", lambda *args: calls.append(args) or paginate(*args)
+    )
+    cache_dir = str(tmp_path / "cache")
+    for _ in range(3):
+        build(
+            str(doc_path), str(tmp_path / "output"), template_dir(), cache_dir=cache_dir
+        )
+    # Only the first build paginates, the others load the cached pages
+    assert len(calls) == 1
+
+
+def test_cached_chunks_do_not_depend_on_location(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+
+    def build_deck(name, with_image=True):
+        deck_dir = tmp_path / name
+        deck_dir.mkdir(exist_ok=True)
+        (deck_dir / "doc.md").write_text("# Title\n![Image](image.png)")
+        image = deck_dir / "image.png"
+        if with_image:
+            image.write_text("fake image content")
+        elif image.exists():
+            image.unlink()
+        output_dir = deck_dir / "output"
+        build(
+            str(deck_dir / "doc.md"),
+            str(output_dir),
+            template_dir(),
+            cache_dir=cache_dir,
+        )
+        with open(output_dir / "index.html", encoding="utf8") as f:
+            return f.read()
+
+    # A copy of the deck elsewhere reuses the cached chunk
+    first = build_deck("a")
+    assert build_deck("b") == first
+    # Once the image is gone the url is left as written, like in a cold build
+    html = build_deck("a", with_image=False)
+    assert 'src="image.png"' in html
+    assert str(tmp_path) not in html
+
+
 def test_retrieve_structure():
     doc = """
 # Title
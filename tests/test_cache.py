@@ -0,0 +1,119 @@
+import os
+
+import pytest
+
+from moffee.utils.cache import DiskCache, RenderCache, content_key
+
+
+def test_content_key_depends_on_fingerprint():
+    assert content_key("text", "a") == content_key("text", "a")
+    assert content_key("text", "a") != content_key("text", "b")
+    assert content_key("text", "a") != content_key("other", "a")
+
+
+def test_hit_and_miss_counters():
+    cache = RenderCache()
+    assert cache.get("k") is None
+    cache.put("k", "<p>v</p>")
+    assert cache.get("k") == "<p>v</p>"
+    assert cache.hits == 1
+    assert cache.misses == 1
+
+
+def test_evicts_least_recently_used_entry():
+    cache = RenderCache(max_entries=2)
+    cache.put("a", "1")
+    cache.put("b", "2")
+    cache.get("a")
+    cache.put("c", "3")
+    assert "a" in cache
+    assert "b" not in cache
+    assert "c" in cache
+    assert cache.evictions == 1
+
+
+def test_byte_cap():
+    cache = RenderCache(max_bytes=10)
+    cache.put("a", "12345")
+    cache.put("b", "12345")
+    assert cache.size == 10
+    cache.put("c", "1")
+    assert "a" not in cache
+    assert cache.size == 6
+    # Entries larger than the whole cache are not stored
+    cache.put("d", "x" * 11)
+    assert "d" not in cache
+
+
+def test_resize_evicts():
+    cache = RenderCache()
+    for i in range(5):
+        cache.put(str(i), "v")
+    cache.resize(max_entries=2)
+    assert len(cache) == 2
+    assert "4" in cache
+
+
+def test_disk_cache_roundtrip(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    assert cache.get("chunks", "k") is None
+    cache.put("chunks", "k", b"<p>v</p>")
+    assert cache.get("chunks", "k") == b"<p>v</p>"
+    # Another process opening the same directory sees the entry
+    assert DiskCache(str(tmp_path)).get("chunks", "k") == b"<p>v</p>"
+    assert cache.get("pages", "k") is None
+
+
+def test_disk_cache_is_versioned(tmp_path):
+    DiskCache(str(tmp_path), version="1").put("chunks", "k", b"old")
+    assert DiskCache(str(tmp_path), version="2").get("chunks", "k") is None
+
+
+def test_disk_cache_evicts_least_recently_used(tmp_path):
+    cache = DiskCache(str(tmp_path), max_bytes=30)
+    cache.put("chunks", "a", b"x" * 10)
+    cache.put("chunks", "b", b"x" * 10)
+    # Make "a" the oldest entry
+    path_a = cache._path("chunks", "a")
+    os.utime(path_a, (0, 0))
+    cache.put("chunks", "c", b"x" * 20)
+    assert cache.get("chunks", "a") is None
+    assert cache.get("chunks", "c") == b"x" * 20
+    assert cache.stats()["bytes"] <= 30
+
+
+def test_disk_cache_clear(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    cache.put("chunks", "a", b"1")
+    cache.put("pages", "b", b"2")
+    cache.clear()
+    assert cache.stats()["entries"] == 0
+    assert cache.get("chunks", "a") is None
+
+
+def test_disk_cache_only_touches_its_entries(tmp_path):
+    notes = tmp_path / "src" / "notes.txt"
+    notes.parent.mkdir()
+    notes.write_text("keep me")
+    readme = tmp_path / "README"
+    readme.write_text("keep me too")
+    stray = tmp_path / "chunks" / "notes.txt"
+    stray.parent.mkdir()
+    stray.write_text("not an entry")
+
+    cache = DiskCache(str(tmp_path), max_bytes=10)
+    cache.put("chunks", "a", b"x" * 20)
+    assert cache.stats()["entries"] == 0
+    cache.put("pages", "b", b"1")
+    assert cache.stats()["entries"] == 1
+    assert cache.stats()["bytes"] == 1
+    cache.clear()
+    assert notes.read_text() == "keep me"
+    assert readme.read_text() == "keep me too"
+    assert stray.read_text() == "not an entry"
+    with pytest.raises(ValueError):
+        cache.put("src", "c", b"1")
+
+
+if __name__ == "__main__":
+    pytest.main()
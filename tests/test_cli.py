@@ -0,0 +1,79 @@
+import os
+import pytest
+from click.testing import CliRunner
+from moffee.cli import cli, deck_outputs, find_documents
+
+
+@pytest.fixture
+def decks(tmp_path):
+    (tmp_path / "talks" / "2024").mkdir(parents=True)
+    (tmp_path / "talks" / "intro.md").write_text("# Intro\nHello")
+    (tmp_path / "talks" / "2024" / "review.md").write_text("# Review\nYear")
+    (tmp_path / "talks" / "notes.txt").write_text("not a deck")
+    (tmp_path / "broken.md").write_text("---\ntheme: missing\n---\n# Broken")
+    return tmp_path
+
+
+def test_find_documents(decks):
+    talks = str(decks / "talks")
+    intro = os.path.join(talks, "intro.md")
+    review = os.path.join(talks, "2024", "review.md")
+    assert find_documents([talks]) == [review, intro]
+    assert find_documents([os.path.join(talks, "*.md"), intro]) == [intro]
+    assert find_documents([os.path.join(talks, "**", "*.md")]) == [review, intro]
+    assert find_documents(["missing.md"]) == ["missing.md"]
+
+
+def test_deck_outputs(decks):
+    documents = find_documents([str(decks / "talks")])
+    assert deck_outputs(documents, None) == [None, None]
+    assert deck_outputs(documents[:1], "out") == ["out"]
+    assert deck_outputs(documents, "out") == [
+        os.path.join("out", "2024", "review.md"),
+        os.path.join("out", "intro.md"),
+    ]
+
+
+def test_deck_outputs_do_not_overlap(tmp_path):
+    (tmp_path / "a").mkdir()
+    nested = [str(tmp_path / "a" / "b.md"), str(tmp_path / "a.md")]
+    assert deck_outputs(nested, "out") == [
+        os.path.join("out", "a", "b.md"),
+        os.path.join("out", "a.md"),
+    ]
+    same_stem = [str(tmp_path / "a.md"), str(tmp_path / "a.markdown")]
+    outputs = deck_outputs(same_stem, "out")
+    assert outputs[0] != outputs[1]
+
+
+def test_make_nested_decks(tmp_path):
+    (tmp_path / "x" / "a").mkdir(parents=True)
+    (tmp_path / "x" / "a" / "b.md").write_text("# B\nInner")
+    (tmp_path / "x" / "a.md").write_text("# A\nOuter")
+    output = str(tmp_path / "out")
+    args = [str(tmp_path / "x" / "a" / "b.md"), str(tmp_path / "x" / "a.md")]
+    result = CliRunner().invoke(cli, ["make", *args, "-o", output, "--no-cache"])
+    assert result.exit_code == 0
+    assert os.path.exists(os.path.join(output, "a", "b.md", "index.html"))
+    assert os.path.exists(os.path.join(output, "a.md", "index.html"))
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_make_many(decks, jobs):
+    output = str(decks / "output")
+    args = ["make", str(decks / "talks"), str(decks / "broken.md"), "-o", output]
+    result = CliRunner().invoke(cli, args + ["--no-cache", "-j", jobs])
+    assert result.exit_code == 1
+    assert "2 built, 1 failed" in result.output
+    assert "Theme 'missing' not found" in result.output
+    assert os.path.exists(os.path.join(output, "talks", "intro.md", "index.html"))
+    review = os.path.join(output, "talks", "2024", "review.md", "index.html")
+    assert os.path.exists(review)
+
+
+def test_make_many_succeeds(decks):
+    output = str(decks / "output")
+    args = ["make", str(decks / "talks"), "-o", output, "--no-cache", "-j", "2"]
+    result = CliRunner().invoke(cli, args)
+    assert result.exit_code == 0
+    assert "2 built, 0 failed" in result.output
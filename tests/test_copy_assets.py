@@ -5,8 +5,11 @@ import shutil
 import tempfile
 from urllib.parse import quote
 
+from moffee.utils import file_helper
 from moffee.utils.file_helper import (
+    AssetStore,
     copy_assets,
+    materialize,
 )
 
 
@@ -221,3 +224,104 @@ def test_copy_assets_handles_encoded_urls(setup_file_with_spaces):
 
     # Verify that the original file name (with spaces) is not in the updated document
     assert sample_file_name not in updated_doc
+
+
+def test_copy_assets_is_content_addressed(setup_test_environment):
+    temp_dir, sample_image_path, _ = setup_test_environment
+    target_dir = os.path.join(temp_dir, "asset_resources")
+    duplicate_path = os.path.join(temp_dir, "duplicate.png")
+    shutil.copy(sample_image_path, duplicate_path)
+
+    html_doc = f'<img src="{sample_image_path}"><img src="{duplicate_path}">'
+    updated_doc = copy_assets(html_doc, target_dir)
+
+    # Identical files are stored once
+    moved_files = os.listdir(target_dir)
+    assert len(moved_files) == 1
+    assert moved_files[0].endswith(".png")
+    assert updated_doc.count(moved_files[0]) == 2
+
+    # Copying again reuses the file and gives the same document
+    mtime = os.stat(os.path.join(target_dir, moved_files[0])).st_mtime_ns
+    assert copy_assets(html_doc, target_dir) == updated_doc
+    assert os.stat(os.path.join(target_dir, moved_files[0])).st_mtime_ns == mtime
+
+
+@pytest.mark.parametrize("mode", ["copy", "hardlink", "reflink", "symlink", "auto"])
+def test_copy_assets_modes(setup_test_environment, mode):
+    temp_dir, sample_image_path, _ = setup_test_environment
+    target_dir = os.path.join(temp_dir, "asset_resources")
+
+    updated_doc = copy_assets(f'<img src="{sample_image_path}">', target_dir, mode)
+
+    moved_files = os.listdir(target_dir)
+    assert len(moved_files) == 1
+    assert os.path.join(target_dir, moved_files[0]) in updated_doc
+    with open(os.path.join(target_dir, moved_files[0])) as f:
+        assert f.read() == "This is a test image file."
+
+
+def test_materialize_falls_back_to_copy(setup_test_environment, monkeypatch):
+    temp_dir, sample_image_path, _ = setup_test_environment
+
+    def unsupported(source, target):
+        raise OSError("Not supported")
+
+    monkeypatch.setitem(file_helper._materializers, "hardlink", unsupported)
+    target = os.path.join(temp_dir, "linked.png")
+    assert materialize(sample_image_path, target, "hardlink") == "copy"
+    assert not os.path.islink(target)
+    target = os.path.join(temp_dir, "auto.png")
+    assert materialize(sample_image_path, target, "auto") == "symlink"
+
+
+def test_asset_store_copies_concurrently(tmp_path):
+    target_dir = tmp_path / "assets"
+    target_dir.mkdir()
+    urls = []
+    for i in range(20):
+        path = tmp_path / f"image {i}.png"
+        path.write_text(f"image {i % 10}")
+        urls.append(quote(str(path)))
+    missing = str(tmp_path / "missing.png")
+
+    store = AssetStore(str(target_dir), max_workers=4)
+    for url in urls + urls + [missing, "https://example.com/a.png"]:
+        store.add(url)
+    assert store.new_path(urls[0]) is None
+
+    calls = []
+    store.copy_all(progress=lambda done, total: calls.append((done, total)))
+    assert calls == [(i, 20) for i in range(1, 21)]
+    assert not store.failed
+    # Ten distinct contents
+    assert len(os.listdir(target_dir)) == 10
+    assert store.new_path(urls[0]) == store.new_path(urls[10])
+    assert store.new_path(missing) is None
+
+
+def test_asset_store_records_failures(tmp_path):
+    (tmp_path / "a.png").write_text("image")
+    store = AssetStore(str(tmp_path / "does-not-exist"))
+    store.add(str(tmp_path / "a.png"))
+    store.copy_all()
+    assert list(store.failed) == [str(tmp_path / "a.png")]
+    assert store.new_path(str(tmp_path / "a.png")) is None
+
+
+@pytest.mark.parametrize("mode", ["symlink", "hardlink"])
+def test_copy_mode_replaces_links(setup_test_environment, mode):
+    temp_dir, sample_image_path, _ = setup_test_environment
+    target_dir = os.path.join(temp_dir, "asset_resources")
+    copy_assets(f'<img src="{sample_image_path}">', target_dir, mode)
+    copy_assets(f'<img src="{sample_image_path}">', target_dir, "copy")
+
+    # The copy no longer follows edits of the source
+    (target,) = os.listdir(target_dir)
+    target = os.path.join(target_dir, target)
+    assert not os.path.islink(target)
+    assert os.stat(target).st_nlink == 1
+    with open(sample_image_path, "w") as f:
+        f.write("Edited in place.")
+    with open(target) as f:
+        assert f.read() == "This is a test image file."
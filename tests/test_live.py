@@ -0,0 +1,255 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from threading import Event
+import pytest
+from tornado import web
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.testing import bind_unused_port
+from moffee import builder
+from moffee.builder import (
+    BuildCancelled,
+    Document,
+    build,
+    render_in_memory,
+    render_jinja2,
+)
+from moffee.live import (
+    LiveServer,
+    OutputTree,
+    Rebuilder,
+    SlidePatcher,
+    split_slides,
+)
+
+
+def template_dir(name="base"):
+    return os.path.join(os.path.dirname(__file__), "..", "moffee", "templates", name)
+
+
+def test_split_slides():
+    a = '<div data-slide-id="a"><div><!-- <div> --></div></div>'
+    b = '<div class="slide-container" data-slide-id="b">B</div>'
+    shell, slides = split_slides(f"<body>{a}{b}<div>after</div></body>")
+    assert shell == "<body><div>after</div></body>"
+    assert slides == [("a", a), ("b", b)]
+
+
+def test_rendered_slides_are_split():
+    doc = "# Title\nOne\n---\nTwo\n---\nThree"
+    shell, slides = split_slides(render_jinja2(doc, template_dir()))
+    assert len(slides) == 3
+    assert len({slide_id for slide_id, _ in slides}) == 3
+    assert "slide-container" not in shell
+    assert "Two" in slides[1][1]
+    assert "js/live.js" not in shell
+    assert "js/live.js" in render_jinja2(doc, template_dir(), live=True)
+
+
+def test_patch_only_changed_slides():
+    doc = "# Title\nOne\n---\nTwo\n---\nThree"
+    patcher = SlidePatcher()
+    assert patcher.update(render_jinja2(doc, template_dir())) is None
+    ids = list(patcher.slides)
+
+    patch = patcher.update(render_jinja2(doc.replace("Two", "2"), template_dir()))
+    assert patch["order"][0] == ids[0] and patch["order"][2] == ids[2]
+    assert list(patch["slides"]) == [patch["order"][1]]
+    assert "2" in patch["slides"][patch["order"][1]]
+
+    unchanged = patcher.update(render_jinja2(doc.replace("Two", "2"), template_dir()))
+    assert unchanged == {"order": patch["order"], "slides": {}}
+
+
+def test_patch_reloads_when_page_changes():
+    doc = "# Title\nOne\n---\nTwo"
+    patcher = SlidePatcher()
+    patcher.update(render_jinja2(doc, template_dir()))
+    html = render_jinja2(doc.replace("Title", "Other"), template_dir())
+    assert patcher.update(html) is None
+
+
+def run_rebuilder(build, actions, delay=0.05):
+    """Run actions(rebuilder) on a fresh loop and collect what is done"""
+    done = []
+    rebuilder = Rebuilder(
+        build, lambda result, reload: done.append((result, reload)), delay=delay
+    )
+
+    async def main():
+        await actions(rebuilder)
+        await asyncio.sleep(delay * 4)
+
+    IOLoop().run_sync(main)
+    return done
+
+
+def test_rebuilder_coalesces_changes():
+    builds = []
+
+    def build(cancel):
+        builds.append(cancel)
+        return len(builds)
+
+    async def actions(rebuilder):
+        rebuilder.schedule()
+        await asyncio.sleep(0.01)
+        rebuilder.schedule(reload=True)
+        rebuilder.schedule()
+
+    assert run_rebuilder(build, actions) == [(1, True)]
+    assert len(builds) == 1
+
+
+def test_rebuilder_cancels_stale_builds():
+    started = Event()
+
+    def build(cancel):
+        if not started.is_set():
+            started.set()
+            cancel.wait(5)
+            raise BuildCancelled()
+        return "second"
+
+    async def actions(rebuilder):
+        rebuilder.schedule(reload=True)
+        while not started.is_set():
+            await asyncio.sleep(0.01)
+        rebuilder.schedule()
+
+    # The stale build is never done, its reload is carried over
+    assert run_rebuilder(build, actions) == [("second", True)]
+
+
+def test_cancelled_build_keeps_output(tmp_path):
+    doc_path = tmp_path / "doc.md"
+    doc_path.write_text("# Title\nText")
+    output_dir = str(tmp_path / "output")
+    build(str(doc_path), output_dir, template_dir())
+    with open(os.path.join(output_dir, "index.html"), encoding="utf8") as f:
+        html = f.read()
+
+    doc_path.write_text("# Other\nText")
+    cancel = Event()
+    cancel.set()
+    with pytest.raises(BuildCancelled):
+        build(str(doc_path), output_dir, template_dir(), cancel=cancel)
+    with open(os.path.join(output_dir, "index.html"), encoding="utf8") as f:
+        assert f.read() == html
+
+
+def test_render_in_memory(tmp_path):
+    (tmp_path / "image.png").write_text("fake image content")
+    doc_path = tmp_path / "doc.md"
+    doc_path.write_text("# Title\n![Image](image.png)")
+    document = Document.load(str(doc_path))
+    html, assets = render_in_memory(document, template_dir())
+    assert len(assets) == 1
+    source, name = assets.popitem()
+    assert source == str(tmp_path / "image.png")
+    assert f'src="{name}"' in html
+    # Nothing is written
+    assert sorted(os.listdir(tmp_path)) == ["doc.md", "image.png"]
+
+
+def test_render_in_memory_resolves_each_url_once(tmp_path, monkeypatch):
+    (tmp_path / "image.png").write_text("fake image content")
+    monkeypatch.chdir(tmp_path)
+    calls = []
+    asset_source = builder.asset_source
+    monkeypatch.setattr(
+        builder, "asset_source", lambda url: calls.append(url) or asset_source(url)
+    )
+    # Parsed from text, without a path
+    document = Document.parse("# Title\n" + "![Image](image.png)\n" * 50)
+    html, assets = render_in_memory(document, template_dir())
+    assert list(assets) == [str(tmp_path / "image.png")]
+    assert html.count(f'src="{assets[str(tmp_path / "image.png")]}"') == 50
+    assert calls.count(str(tmp_path / "image.png")) == 1
+
+
+def test_render_in_memory_with_executor(tmp_path):
+    doc_path = tmp_path / "doc.md"
+    doc_path.write_text("# Title\n" + "\n---\n".join(f"Slide {i}" for i in range(80)))
+    document = Document.load(str(doc_path))
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=2, mp_context=context) as executor:
+        html, _ = render_in_memory(document, template_dir(), jobs=2, executor=executor)
+    assert html == render_in_memory(document, template_dir())[0]
+    assert "Slide 79" in html
+
+
+def test_output_tree(tmp_path):
+    source = tmp_path / "image.png"
+    source.write_text("fake image content")
+    tree = OutputTree([template_dir("beam"), template_dir()])
+    tree.update("<html></html>", {str(source): "assets/abc.png"})
+
+    assert tree.resolve("") == b"<html></html>"
+    assert tree.resolve("/index.html") == b"<html></html>"
+    assert tree.resolve("assets/abc.png") == str(source)
+    # The theme's static files come first, templates are not served
+    css = os.path.join(template_dir("beam"), "css", "extension.css")
+    assert tree.resolve("css/extension.css") == css
+    assert tree.resolve("js/main.js") == os.path.join(template_dir(), "js", "main.js")
+    assert tree.resolve("layouts/content.html") is None
+    assert tree.resolve("css/../../beam/css/extension.css") is None
+    assert tree.resolve("missing.css") is None
+
+
+def test_output_handler(tmp_path):
+    source = tmp_path / "image.png"
+    source.write_text("fake image content")
+    tree = OutputTree([template_dir()])
+    tree.update("<html></html>", {str(source): "assets/abc.png"})
+
+    async def fetch_all():
+        sock, port = bind_unused_port()
+        server = HTTPServer(web.Application(LiveServer(tree).get_web_handlers("")))
+        server.add_sockets([sock])
+        client = AsyncHTTPClient()
+        responses = []
+        for path in ["", "assets/abc.png", "missing.png"]:
+            url = f"http://127.0.0.1:{port}/{path}"
+            responses.append(await client.fetch(url, raise_error=False))
+        server.stop()
+        return responses
+
+    index, asset, missing = IOLoop().run_sync(fetch_all)
+    assert index.body == b"<html></html>"
+    assert index.headers["Content-Type"].startswith("text/html")
+    assert asset.body == b"fake image content"
+    assert missing.code == 404
+
+
+def test_refresh_asset(tmp_path):
+    (tmp_path / "a.png").write_text("a")
+    (tmp_path / "b.png").write_text("b")
+    doc_path = tmp_path / "doc.md"
+    doc_path.write_text("# Title\n![A](a.png)\n---\n![B](b.png)\n---\nText")
+    tree = OutputTree([template_dir()])
+    tree.update(*render_in_memory(Document.load(str(doc_path)), template_dir()))
+    patcher = SlidePatcher()
+    patcher.update(tree.html)
+    assert tree.refresh_asset(str(tmp_path / "a.png"))
+    assert patcher.update(tree.html)["slides"] == {}
+
+    # Only the slide showing the changed file is patched
+    (tmp_path / "a.png").write_text("new a")
+    assert tree.refresh_asset(str(tmp_path / "a.png"))
+    patch = patcher.update(tree.html)
+    assert list(patch["slides"]) == [patch["order"][0]]
+    name = tree.assets[str(tmp_path / "a.png")]
+    assert name in patch["slides"][patch["order"][0]]
+    assert tree.resolve(name) == str(tmp_path / "a.png")
+    html, _ = render_in_memory(Document.load(str(doc_path)), template_dir())
+    assert tree.html == html
+
+    # Files sharing a name cannot be told apart in the html
+    (tmp_path / "b.png").write_text("new a")
+    tree.update(*render_in_memory(Document.load(str(doc_path)), template_dir()))
+    (tmp_path / "b.png").write_text("b")
+    assert not tree.refresh_asset(str(tmp_path / "b.png"))
@@ -0,0 +1,74 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+import pytest
+from markdown import markdown
+
+from moffee.markdown import (
+    ConverterPool,
+    converter_pool,
+    extension_configs,
+    extensions,
+    md,
+    render_cache,
+    render_many,
+)
+
+SAMPLES = [
+    "# Heading\n\nSome *text* with a footnote[^1].\n\n[^1]: The note.",
+    "Term with an ABBR.\n\n*[ABBR]: Abbreviation",
+    "| a | b |\n|---|---|\n| 1 | 2 |",
+    "> [!note] Title\n> Text",
+    "```mermaid\ngraph TD\nA-->B\n```",
+    "Inline $x^2$ and block\n\n$$\n\\frac{a}{b}\n$$",
+    "- [x] done\n- [ ] todo\n\n==marked== ^^ins^^ ~~del~~",
+    "# Heading\n\n# Heading\n\n<div markdown>*html*</div>",
+]
+
+
+def reference(text):
+    return markdown(text, extensions=extensions, extension_configs=extension_configs)
+
+
+def test_pooled_output_is_identical():
+    # Convert twice so the second round goes through reset converters
+    for _ in range(2):
+        for text in SAMPLES:
+            assert md(text) == reference(text)
+
+
+def test_pool_reuses_converters():
+    pool = ConverterPool(extensions, extension_configs)
+    with pool.converter() as first:
+        pass
+    with pool.converter() as second:
+        pass
+    assert first is second
+
+
+def test_pool_is_thread_safe():
+    texts = SAMPLES * 20
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(converter_pool.convert, texts))
+    assert results == [reference(text) for text in texts]
+
+
+def test_rendered_chunks_are_cached():
+    text = "Cached *chunk* that appears in no other test"
+    hits = render_cache.hits
+    first = md(text)
+    second = md(text)
+    assert first == second
+    assert render_cache.hits == hits + 1
+
+
+def test_render_many_matches_serial_rendering():
+    texts = [f"Slide {i}\n\n- item *{i}*" for i in range(100)] + SAMPLES
+    rendered = render_many(texts, jobs=2)
+    assert list(rendered) == list(dict.fromkeys(texts))
+    for text in texts:
+        assert rendered[text] == reference(text)
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -8,6 +8,7 @@ from moffee.utils.md_helper import (
     contains_deco,
     extract_title,
     rm_comments,
+    iter_rm_comments,
 )
 
 
@@ -152,3 +153,17 @@ def test_no_comments():
     document with no comments.
     """
     assert multi_strip(rm_comments(markdown)) == multi_strip(markdown)
+
+
+@pytest.mark.parametrize(
+    "markdown",
+    [
+        "a <!-- b --> c <!-- d\ne --> f\n%% g\nh",
+        "text\n\n  \n%% note\n\n%% again\nmore",
+        "<!-- unclosed\n%% kept",
+        "<!--> still open\n-->closed",
+    ],
+)
+def test_iter_rm_comments_matches_rm_comments(markdown):
+    lines = iter_rm_comments(markdown.split("\n"))
+    assert "\n".join(lines).strip() == rm_comments(markdown)
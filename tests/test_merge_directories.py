@@ -0,0 +1,60 @@
+import os
+import pytest
+
+from moffee.utils.file_helper import merge_directories
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+@pytest.fixture
+def directories(tmp_path):
+    base_dir = str(tmp_path / "base")
+    theme_dir = str(tmp_path / "theme")
+    output_dir = str(tmp_path / "output")
+    write(os.path.join(base_dir, "index.html"), "base index")
+    write(os.path.join(base_dir, "css", "styles.css"), "base styles")
+    write(os.path.join(base_dir, "css", "extension.css"), "base extension")
+    write(os.path.join(theme_dir, "css", "extension.css"), "theme extension")
+    return base_dir, theme_dir, output_dir
+
+
+def test_merge_directories(directories):
+    base_dir, theme_dir, output_dir = directories
+    merge_directories(base_dir, output_dir, theme_dir)
+    assert read(os.path.join(output_dir, "index.html")) == "base index"
+    assert read(os.path.join(output_dir, "css", "styles.css")) == "base styles"
+    assert read(os.path.join(output_dir, "css", "extension.css")) == "theme extension"
+
+
+def test_merge_directories_is_incremental(directories):
+    base_dir, theme_dir, output_dir = directories
+    merge_directories(base_dir, output_dir, theme_dir)
+    # Same size and mtime as its source, so it counts as unchanged
+    styles = os.path.join(output_dir, "css", "styles.css")
+    write(styles, "BASE STYLES")
+    os.utime(styles, ns=(0, 0))
+    os.utime(os.path.join(base_dir, "css", "styles.css"), ns=(0, 0))
+
+    write(os.path.join(output_dir, "assets", "image.png"), "asset")
+    write(os.path.join(output_dir, "stale", "old.css"), "stale")
+    write(os.path.join(output_dir, "old.js"), "stale")
+    write(os.path.join(theme_dir, "css", "extension.css"), "new theme extension")
+    merge_directories(base_dir, output_dir, theme_dir, keep=["assets"])
+
+    # Unchanged files are not copied again
+    assert read(styles) == "BASE STYLES"
+    assert (
+        read(os.path.join(output_dir, "css", "extension.css")) == "new theme extension"
+    )
+    assert os.path.exists(os.path.join(output_dir, "assets", "image.png"))
+    assert not os.path.exists(os.path.join(output_dir, "stale"))
+    assert not os.path.exists(os.path.join(output_dir, "old.js"))
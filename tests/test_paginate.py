@@ -1,5 +1,24 @@
+import io
+import random
+
 import pytest
-from moffee.compositor import composite, Direction, Type
+from moffee.compositor import (
+    composite,
+    diff_lines,
+    iter_pages,
+    paginate,
+    parse_frontmatter,
+    repaginate,
+    tokenize,
+    Direction,
+    Type,
+)
+from moffee.utils.md_helper import (
+    contains_deco,
+    get_header_level,
+    is_comment,
+    is_divider,
+)
 
 
 @pytest.fixture
@@ -252,6 +271,23 @@ Paragraph 4
     assert len(next.children) == 3
 
 
+def test_chunk_tree_is_cached():
+    doc = """
+Paragraph 1
+===
+Paragraph 2
+<->
+Paragraph 3
+    """
+    page = composite(doc)[0]
+    assert page.chunk is page.chunk
+    assert not hasattr(page, "__dict__")
+    assert not hasattr(page.chunk, "__dict__")
+    # Paragraphs are slices of the page text
+    assert page.chunk.children[0].source is page.raw_md
+    assert page.chunk.children[1].children[1].paragraph.strip() == "Paragraph 3"
+
+
 def test_empty_lines_handling():
     doc = """
 # Title
@@ -301,5 +337,120 @@ Hello
     assert pages[1].option.default_h1 is False
 
 
+def test_tokenize_matches_line_helpers():
+    lines = [
+        "# Header 1",
+        "###### Header 6",
+        "####### Not a header",
+        "#NoSpace",
+        "  ---  ",
+        "***",
+        "___",
+        "<->",
+        "=====",
+        "--",
+        "@(layout=split, background=blue)",
+        "  @(a=b)  ",
+        "<!-- comment -->",
+        "   ",
+        "Plain text",
+    ]
+    for token in tokenize(lines):
+        line = token.text
+        assert token.header_level == get_header_level(line)
+        assert (token.divider is not None) == is_divider(line)
+        if token.divider:
+            assert is_divider(line, token.divider)
+        assert token.deco == contains_deco(line)
+        assert token.comment == is_comment(line)
+        assert token.blank == (line.strip() == "")
+
+
+def test_tokenize_tracks_code_blocks():
+    tokens = list(tokenize(["text", "```python", "# comment", "---", "```", "---"]))
+    assert [t.escaped for t in tokens] == [False, True, True, True, False, False]
+    assert [t.fence for t in tokens] == [False, True, False, False, True, False]
+    assert tokens[2].header_level == 1
+    assert tokens[3].divider == "-"
+
+
+def test_iter_pages_matches_composite(sample_document):
+    document = "<!-- note -->\n" + sample_document + "%% trailing comment\n"
+    pages = list(iter_pages(io.StringIO(document)))
+    expected = composite(document)
+    assert [(p.raw_md, p.h1, p.h2, p.h3, p.option) for p in pages] == [
+        (p.raw_md, p.h1, p.h2, p.h3, p.option) for p in expected
+    ]
+    assert pages[0].option.default_h1 is True
+
+
+def test_iter_pages_is_lazy():
+    read = []
+
+    def lines():
+        for i in range(1000):
+            read.append(i)
+            yield f"# Slide {i}\n"
+            yield "Text\n"
+
+    pages = iter_pages(lines())
+    assert next(pages).h1 == "Slide 0"
+    assert len(read) <= 2
+
+
+def test_page_line_ranges():
+    content = "# Title\nText\n---\nMore\n## Sub\nEnd"
+    pages = paginate(content, parse_frontmatter("")[1])
+    assert [(page.start, page.end) for page in pages] == [(0, 3), (3, 4), (4, 6)]
+
+
+def page_summary(pages):
+    return [
+        (page.raw_md, page.h1, page.h2, page.h3, page.start, page.end, page.option)
+        for page in pages
+    ]
+
+
+def check_repaginate(old, new, frontmatter="---\ndefault_h1: true\n---"):
+    _, options = parse_frontmatter(frontmatter)
+    pages = paginate(old, options)
+    before = page_summary(pages)
+    edit = diff_lines(old.split("\n"), new.split("\n"))
+    updated = repaginate(pages, new, options, edit)
+    assert page_summary(updated) == page_summary(paginate(new, options))
+    # Previous pages are left untouched
+    assert page_summary(pages) == before
+
+
+def test_repaginate_edit_inside_page():
+    old = "# A\nText\n---\nMore\n---\nLast"
+    check_repaginate(old, old.replace("More", "Changed\nand longer"))
+
+
+def test_repaginate_header_inheritance_spills():
+    old = "# A\nText\n---\nMore\n---\n## Sub\nLast\n---\nEnd"
+    check_repaginate(old, old.replace("# A", "# Renamed"))
+    check_repaginate(old, old.replace("More", "# New section\nMore"))
+
+
+def test_repaginate_code_block():
+    old = "# A\nText\n---\nMore\n---\n## Sub\nLast"
+    check_repaginate(old, old.replace("More", "```\nMore"))
+    check_repaginate(old.replace("More", "```\nMore"), old)
+
+
+def test_repaginate_random_edits():
+    rng = random.Random(0)
+    pool = ["# A", "## B", "### C", "#### D", "text", "", "---", "===", "<->"]
+    pool += ["```", "@(layout=centered)", "@(background=red)"]
+    for _ in range(300):
+        old = [rng.choice(pool) for _ in range(rng.randint(0, 30))]
+        new = list(old)
+        start = rng.randint(0, len(new))
+        end = rng.randint(start, min(len(new), start + 3))
+        new[start:end] = [rng.choice(pool) for _ in range(rng.randint(0, 3))]
+        check_repaginate("\n".join(old), "\n".join(new))
+
+
 if __name__ == "__main__":
     pytest.main()
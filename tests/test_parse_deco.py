@@ -1,3 +1,5 @@
+from dataclasses import FrozenInstanceError
+
 import pytest
 
 from moffee.compositor import parse_deco, PageOption
@@ -75,6 +77,26 @@ def test_deco_with_complex_url():
     }
 
 
+def test_deco_shares_base_option():
+    base_option = PageOption(styles={"color": "red"})
+
+    option = parse_deco("@(layout=split)", base_option)
+    assert option.layout == "split"
+    assert base_option.layout == "content"
+    assert option.styles is base_option.styles
+
+    option = parse_deco("@(background=blue)", base_option)
+    assert option.styles == {"color": "red", "background": "blue"}
+    assert base_option.styles == {"color": "red"}
+
+    assert parse_deco("@()", base_option) is base_option
+
+
+def test_option_is_immutable():
+    with pytest.raises(FrozenInstanceError):
+        PageOption().layout = "split"
+
+
 def test_computed_slide_size():
     page_option = PageOption()
     assert page_option.computed_slide_size == (720, 405)
@@ -2,7 +2,12 @@ from urllib.parse import quote
 import pytest
 import tempfile
 import os
-from moffee.utils.file_helper import redirect_paths
+from moffee.utils.file_helper import (
+    PathIndex,
+    redirect_paths,
+    rewrite_url_stream,
+    rewrite_urls,
+)
 
 
 @pytest.fixture(scope="module", autouse=True)
@@ -102,3 +107,65 @@ invalid: "invalid.txt"
 """
     redirected_document = redirect_paths(document, doc_path)
     assert redirected_document == document
+
+
+def test_rewrite_urls_only_touches_url_attributes():
+    document = (
+        '<p>src="a.png"</p><IMG ALT="a.png" SRC=\'a.png\'>'
+        '<a title="x" href="a&amp;b.png">a.png</a><abbr href="a.png">'
+    )
+    rewritten = rewrite_urls(document, lambda url: "new/" + url)
+    assert rewritten == (
+        '<p>src="a.png"</p><IMG ALT="a.png" SRC="new/a.png">'
+        '<a title="x" href="new/a&amp;b.png">a.png</a><abbr href="a.png">'
+    )
+
+
+def test_rewrite_url_stream_matches_rewrite_urls():
+    document = "".join(f'<div><img src="{i}.png" alt="{i}"></div>' for i in range(50))
+    # Pieces cutting through tags, with a buffer smaller than a tag
+    pieces = [document[i : i + 7] for i in range(0, len(document), 7)]
+
+    def rewrite(url):
+        return url.upper()
+
+    streamed = "".join(rewrite_url_stream(pieces, rewrite, buffer_size=10))
+    assert streamed == rewrite_urls(document, rewrite)
+
+
+def test_rewrite_url_stream_handles_brackets_in_attributes():
+    document = (
+        '<p>1 < 2</p><img alt="a>b" src="x.png">'
+        '<img alt=\'<a href="y.png">\' src="z.png"><a title="<" href="w.png">w</a>'
+    )
+
+    def rewrite(url):
+        return url.upper()
+
+    expected = rewrite_urls(document, rewrite)
+    assert 'src="X.PNG"' in expected and 'href="y.png"' in expected
+    # Cut the document at every offset, with a buffer smaller than a tag
+    for i in range(1, len(document)):
+        pieces = [document[:i], document[i:]]
+        streamed = "".join(rewrite_url_stream(pieces, rewrite, buffer_size=1))
+        assert streamed == expected, i
+
+
+def test_path_index(tmp_path):
+    (tmp_path / "a.png").write_text("fake image content")
+    (tmp_path / "sub").mkdir()
+    index = PathIndex()
+    for name in ["a.png", "sub", "b.png", "sub/a.png", "missing/a.png"]:
+        path = str(tmp_path / name)
+        assert index.exists(path) == os.path.exists(path)
+
+    base_paths = [str(tmp_path / "sub"), str(tmp_path)]
+    assert index.resolve("a.png", base_paths) == str(tmp_path / "a.png")
+    assert index.resolve("b.png", base_paths) == "b.png"
+
+    # New files are only seen after a refresh
+    (tmp_path / "sub" / "a.png").write_text("fake image content")
+    assert index.resolve("a.png", base_paths) == str(tmp_path / "a.png")
+    os.utime(tmp_path / "sub", ns=(0, 0))
+    index.refresh()
+    assert index.resolve("a.png", base_paths) == str(tmp_path / "sub" / "a.png")